@@ -3,35 +3,60 @@
 import os
 import sys
 
-from flask.cli import FlaskGroup
-
-from ecs import create_app, tasks, cache
-from ecs.config import AppConfig
-from ecs import db
-from ecs.tasks.aliyun import Aliyun
-from ecs.tasks.cron import Cron
-
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 venv_path = os.environ.get("VENV_PATH", ".env")
-print(venv_path)
 #: windows
 if os.name == 'nt':
-    activate_this = os.path.join(AppConfig.BASE_DIR, venv_path, 'Scripts', 'activate_this.py')
+    activate_this = os.path.join(BASE_DIR, venv_path, 'Scripts', 'activate_this.py')
 else:
 #: activate_this path
-    activate_this = os.path.join(AppConfig.BASE_DIR, venv_path, 'bin', 'activate_this.py')
+    activate_this = os.path.join(BASE_DIR, venv_path, 'bin', 'activate_this.py')
+
+#: active virtualenv, before any third-party import, unless it already runs in it or there is none
+if os.path.exists(activate_this) and not sys.prefix.startswith(os.path.abspath(os.path.join(BASE_DIR, venv_path))):
+    with open(activate_this) as f:
+        code = compile(f.read(), activate_this, 'exec')
+        exec(code, dict(__file__=activate_this))
+
+import click
+from flask import current_app
+from flask.cli import FlaskGroup
+
+from ecs import create_app, cache
+from ecs import db
 
-#: active virtualenv
-with open(activate_this) as f:
-    code = compile(f.read(), activate_this, 'exec')
-    exec(code, dict(__file__=activate_this))
+_app = None
 
-app = create_app(os.path.join(AppConfig.BASE_DIR, "config.yml"))
-fg = FlaskGroup(app)
+
+def load_app(info=None):
+    """
+    The app is built on first use, importing this module has no side effects.
+    :param info: flask.cli.ScriptInfo, passed by older Flask versions
+    """
+    global _app
+    if _app is None:
+        _app = create_app(os.path.join(BASE_DIR, "config.yml"))
+        _app.shell_context_processor(make_shell_context)
+    return _app
+
+
+def __getattr__(name):
+    """
+    `Ecs_app.app` built lazily on attribute access, Python 3.7+ (PEP 562).
+    WSGI servers that eval the name in the module namespace (gunicorn) do not see it, use `wsgi:app`.
+    """
+    if name == "app":
+        return load_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+fg = FlaskGroup(create_app=load_app)
 
 
-@app.shell_context_processor
 def make_shell_context():
-    model_dict = dict(app=app, db=db, cache=cache, tasks=tasks)
+    from ecs import tasks
+
+    model_dict = dict(app=load_app(), db=db, cache=cache, tasks=tasks)
     
     return model_dict
 
@@ -43,11 +68,101 @@ def recreate_db():
     db.session.commit()
 
 
+@fg.command("backfill", help="Backfill ActionTrail events, times are ISO 8601 UTC, e.g. 2021-01-01T00:00:00Z")
+@click.option("--start", "start_time", required=True, help="start time")
+@click.option("--end", "end_time", default=None, help="end time, defaults to now")
+@click.option("--window", default=60, help="window size in minutes")
+@click.option("--workers", default=4, help="concurrent fetches")
+@click.option("--account", default=None, help="shard account, defaults to the first configured shard")
+@click.option("--region", "region_id", default=None, help="shard region")
+def backfill(start_time, end_time, window, workers, account, region_id):
+    from ecs import metrics, tasks
+    from ecs.tasks.cron import Cron
+
+    result = Cron.execute("backfill_aliyun_events", start_time, end_time, window=window, workers=workers,
+                          account=account, region_id=region_id)
+    metrics.flush(tasks.rq.connection)
+    click.echo(result)
+
+
+@fg.command("shards", help="Show sync health and lag of every account/region shard, slowest first")
+def shards():
+    from ecs.event_model import SyncCheckpoint
+    from ecs.tasks.aliyun import Aliyun
+
+    config = (current_app.config.get("SRV") or {}).get("ALIYUN")
+    if not config:
+        raise click.ClickException("no SRV.ALIYUN shards configured")
+
+    for shard in SyncCheckpoint.report(Aliyun.shards(config)):
+        lag = "-" if shard["lag"] is None else f"{shard['lag']:.0f}s"
+        duration = "-" if shard["last_duration"] is None else f"{shard['last_duration']:.1f}s"
+        click.echo(f"{shard['account']:<24} {shard['region_id']:<16} lag {lag:<8} {shard['last_status'] or 'never':<9} "
+                   f"{duration:<8} {shard['last_run_at'] or ''}{'' if shard['configured'] else '  (unconfigured)'}")
+        if shard["last_status"] == SyncCheckpoint.failed:
+            click.echo(f"    {shard['last_error']}")
+
+
+@fg.command("storage", help="Estimate the ali_event bytes saved by the identity/user_agent/service dictionary tables")
+def storage():
+    from ecs.event_model import AliEvent
+
+    report = AliEvent.storage_report()
+    click.echo(f"{report['rows']} events")
+    for name, column in report["columns"].items():
+        distinct = f"  {column['distinct']} distinct" if "distinct" in column else ""
+        click.echo(f"{name:<14} {column['before']:>14} -> {column['after']:>14} bytes{distinct}")
+    ratio = f"{report['saved'] / report['before']:.1%}" if report["before"] else "-"
+    click.echo(f"{'total':<14} {report['before']:>14} -> {report['after']:>14} bytes, saved {report['saved']} ({ratio})")
+    for table, size in report.get("tables", {}).items():
+        click.echo(f"{table:<14} {size:>14} bytes on disk")
+
+
+@fg.command("worker", help="Preload task modules and run an rq worker")
+@click.argument("queues", nargs=-1)
+@click.option("--burst", is_flag=True, help="quit after all jobs are processed")
+def worker(queues, burst):
+    from ecs import tasks
+
+    #: the task modules and the SDK load once here, not in every forked job
+    tasks.preload_modules()
+    tasks.rq.get_worker(*queues).work(burst=burst)
+
+
+@fg.command("schedules", help="List the scheduled jobs")
+@click.option("--sync", is_flag=True, help="make the scheduled jobs match ecs.schedules.SCHEDULES first")
+def schedules(sync):
+    from ecs.schedules import sync_schedules, list_schedules
+
+    if sync:
+        click.echo(sync_schedules())
+    for job in list_schedules():
+        click.echo(f"{job['id']:<40} {job['cron'] or job['interval'] or '':<12} {job['next_run']}  "
+                   f"{job['description']}{'' if job['managed'] else '  (unmanaged)'}")
+
+
+@fg.command("profile", help="Write the profile of a job queued with _profile=True, e.g. for snakeviz")
+@click.argument("job_id")
+@click.option("-o", "--output", default=None, help="defaults to <job_id>.prof")
+def profile(job_id, output):
+    from ecs import tasks
+
+    dump = tasks.get_profile(job_id)
+    if dump is None:
+        raise click.ClickException(f"no profile for job {job_id}")
+
+    output = output or f"{job_id}.prof"
+    with open(output, "wb") as f:
+        f.write(dump)
+    click.echo(output)
+
+
 @fg.command("run", help="run server")
 def runserver():
     # Aliyun.sync_events()
     # tasks.run("cron", "sync_aliyun_events")
     # tasks.run.cron("* * * * *", "aliyun sync_events", mn="cron", fn="sync_aliyun_events")
+    app = load_app()
     app.run(host=app.config["HOST"], port=app.config["PORT"], use_reloader=True)
 
 
@@ -0,0 +1,150 @@
+# -*- coding:utf-8 -*-
+"""
+Offline stand-in for the ActionTrail LookupEvents API, serves synthetic pages.
+
+    python actiontrail_stub.py --port 8089 --events-per-minute 200 --latency 0.05
+
+Point Aliapi/AsyncAliapi at it with `endpoint="127.0.0.1:8089"` / `endpoint="http://127.0.0.1:8089"`.
+"""
+import argparse
+import hashlib
+import json
+import random
+import socketserver
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+USERS = ["tim", "ops", "deploy", "audit", "jenkins"]
+AGENTS = ["AliyunConsole", "aliyuncli/2.0.6", "aliyun-sdk-python/2.9.3", "Terraform/0.12.29"]
+APIS = [
+    ("Ecs", "ecs.aliyuncs.com", "StopInstance"), ("Ecs", "ecs.aliyuncs.com", "DescribeInstances"),
+    ("Rds", "rds.aliyuncs.com", "DescribeDBInstances"), ("Ram", "ram.aliyuncs.com", "CreateAccessKey"),
+    ("Slb", "slb.aliyuncs.com", "SetBackendServers"),
+]
+
+
+def synthetic_event(event_time, index):
+    """
+    :param datetime event_time: UTC
+    :param int index: position of the event in the stub timeline, keeps ids stable between requests
+    """
+    user = USERS[index % len(USERS)]
+    service, source, name = APIS[index % len(APIS)]
+    event = {
+        "eventId": hashlib.md5(f"{event_time:%Y%m%d%H%M%S}-{index}".encode()).hexdigest(),
+        "eventName": name, "eventSource": source, "eventType": "ApiCall", "eventVersion": "1",
+        "eventTime": event_time.strftime(TIME_FORMAT), "requestId": hashlib.md5(str(index).encode()).hexdigest(),
+        "serviceName": service, "sourceIpAddress": f"10.0.{index % 250}.{index % 7 + 1}",
+        "userAgent": AGENTS[index % len(AGENTS)],
+        "userIdentity": {
+            "type": "ram-user", "principalId": str(200000 + USERS.index(user)), "accountId": "1234567890",
+            "accessKeyId": f"LTAI{USERS.index(user):012d}", "userName": user,
+        },
+        "requestParameters": {
+            "RegionId": "cn-shenzhen", "InstanceId": f"i-wz9{index:017d}", "AcsHost": source,
+            "HostId": source, "Format": "JSON", "AccessKeyId": f"LTAI{USERS.index(user):012d}",
+        },
+    }
+    if index % 20 == 0:
+        event["errorCode"] = "NoPermission"
+        event["errorMessage"] = "You are not authorized to do this action."
+
+    return event
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ http.server.ThreadingHTTPServer, which is Python 3.7+ """
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_lookup(dict(parse_qsl(urlparse(self.path).query)))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+        params = dict(parse_qsl(urlparse(self.path).query))
+        params.update(parse_qsl(body))
+        self.handle_lookup(params)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_lookup(self, params):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.server.throttle and random.random() < self.server.throttle:
+            return self.reply(400, {"Code": "Throttling.User", "Message": "Request was denied due to user flow control."})
+
+        if params.get("Action") != "LookupEvents":
+            return self.reply(404, {"Code": "InvalidAction.NotFound", "Message": "Specified api is not found"})
+
+        start = datetime.strptime(params["StartTime"], TIME_FORMAT)
+        end = datetime.strptime(params["EndTime"], TIME_FORMAT)
+        max_results = int(params.get("MaxResults", 50))
+        offset = int(params.get("NextToken") or 0)
+
+        #: events sit at fixed slots of the stub timeline so overlapping windows return the same ids
+        step = timedelta(minutes=1) / self.server.events_per_minute
+        first = int((start - self.server.epoch) / step) + (1 if (start - self.server.epoch) % step else 0)
+        last = int((end - self.server.epoch) / step)
+        total = max(last - first + 1, 0)
+
+        events = [
+            synthetic_event(self.server.epoch + step * slot, slot)
+            for slot in range(first + offset, first + min(offset + max_results, total))
+        ]
+        body = {"RequestId": hashlib.md5(self.path.encode()).hexdigest(), "StartTime": params["StartTime"],
+                "EndTime": params["EndTime"], "Events": events}
+        if offset + len(events) < total:
+            body["NextToken"] = str(offset + len(events))
+
+        self.reply(200, body)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 8089), events_per_minute=100, latency=0.0, throttle=0.0):
+        super(StubServer, self).__init__(address, StubHandler)
+        self.events_per_minute = events_per_minute
+        self.latency = latency
+        self.throttle = throttle
+        self.epoch = datetime(2000, 1, 1)
+
+    @property
+    def endpoint(self):
+        return "{}:{}".format(*self.server_address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--events-per-minute", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--throttle", type=float, default=0.0, help="share of requests answered with Throttling.User")
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), args.events_per_minute, args.latency, args.throttle)
+    print(f"ActionTrail stub on http://{server.endpoint}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+from collections import Counter
+from datetime import datetime
+from urllib.parse import quote
+from uuid import uuid4
+
+import aiohttp
+
+from ali import Aliapi, backoff, is_throttled
+
+
+def percent_encode(value):
+    return quote(str(value), safe="~")
+
+
+class AsyncAliapi(object):
+    """
+    asyncio counterpart of ali.Aliapi, requests are signed here and sent over
+    a pooled keep-alive aiohttp session. Throttled and timed out requests are
+    retried with the backoff of Aliapi.
+    """
+    version = "2017-12-04"
+
+    def __init__(self, ak=None, secret=None, region_id="cn-shenzhen", endpoint=None,
+                 session=None, concurrency=8, timeout=10, max_retries=5, base_delay=0.5, max_delay=30):
+        """
+        :param ak: access key
+        :param secret: access secret
+        :param region_id: region of the trail
+        :param endpoint: override the ActionTrail endpoint, e.g. "http://127.0.0.1:8089"
+        :param session: aiohttp.ClientSession shared between clients, created on demand if None
+        :param int concurrency: max requests in flight for this client
+        :param int timeout: request timeout in seconds
+        :param max_retries: retries of throttled/timed out requests
+        :param base_delay: first backoff delay in seconds
+        :param max_delay: backoff cap in seconds
+        """
+        self.ak = ak
+        self.secret = secret
+        self.region_id = region_id
+        self.endpoint = endpoint or f"https://actiontrail.{region_id}.aliyuncs.com"
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        #: requests, retries, throttled, failed, waited (seconds)
+        self.stats = Counter()
+
+        self._session = session
+        self._own_session = session is None
+        #: asyncio primitives bind to the loop current when they are created (3.6), one per loop
+        self._semaphore = self._semaphore_loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = self.create_session(self.concurrency)
+        return self._session
+
+    @property
+    def semaphore(self):
+        """ semaphore of the running loop, only used inside coroutines """
+        loop = asyncio.get_event_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore, self._semaphore_loop = asyncio.Semaphore(self.concurrency), loop
+        return self._semaphore
+
+    @staticmethod
+    def create_session(limit=32):
+        connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=60)
+        return aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self._own_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def sign(self, action, params):
+        """
+        :return str: query string signed with the RPC (HMAC-SHA1) signature
+        """
+        params = dict(params, **{
+            "Format": "JSON", "Version": self.version, "AccessKeyId": self.ak,
+            "SignatureMethod": "HMAC-SHA1", "SignatureVersion": "1.0", "SignatureNonce": uuid4().hex,
+            "Timestamp": Aliapi.get_datetime(), "Action": action, "RegionId": self.region_id
+        })
+        query = "&".join(f"{percent_encode(k)}={percent_encode(v)}" for k, v in sorted(params.items()))
+        string_to_sign = f"GET&{percent_encode('/')}&{percent_encode(query)}"
+        digest = hmac.new(f"{self.secret}&".encode(), string_to_sign.encode(), hashlib.sha1).digest()
+
+        return f"{query}&Signature={percent_encode(base64.b64encode(digest).decode())}"
+
+    @staticmethod
+    def error_code(body):
+        try:
+            return json.loads(body).get("Code")
+        except (ValueError, AttributeError):
+            return None
+
+    async def get_request_result(self, action, params):
+        attempt = 0
+        while True:
+            #: signed on every attempt, a nonce is accepted once
+            url = f"{self.endpoint}/?{self.sign(action, params)}"
+            self.stats["requests"] += 1
+            async with self.semaphore:
+                try:
+                    async with self.session.get(url, timeout=self.timeout) as response:
+                        status, body = response.status, await response.text()
+                except asyncio.TimeoutError:
+                    status, body = None, f"{action} timed out after {self.timeout}s"
+                except aiohttp.ClientError as err:
+                    raise ValueError(err)
+
+            throttled = status is not None and status >= 400 and is_throttled(self.error_code(body), status)
+            if status is not None and not throttled:
+                if status >= 400:
+                    raise ValueError(body)
+                return body
+
+            if throttled:
+                self.stats["throttled"] += 1
+            if attempt >= self.max_retries:
+                self.stats["failed"] += 1
+                raise ValueError(body)
+
+            #: waited outside the semaphore, the other requests of the client go on
+            delay = backoff(attempt, self.base_delay, self.max_delay)
+            self.stats["retries"] += 1
+            self.stats["waited"] += delay
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def iter_events(self, start_time=None, end_time=None, max_results=50):
+        """
+        Async generator of LookupEvents pages, see Aliapi.iter_events.
+        """
+        start_time = start_time or Aliapi.get_datetime(6)
+        end_time = end_time or Aliapi.get_datetime()
+        next_token = None
+        fetched = 0
+
+        while True:
+            params = {"MaxResults": max_results, "StartTime": start_time, "EndTime": end_time}
+            if next_token:
+                params["NextToken"] = next_token
+
+            result = json.loads(await self.get_request_result("LookupEvents", params))
+            fetched += len(result["Events"])
+            yield result["Events"]
+
+            next_token = result.get("NextToken")
+            if isinstance(next_token, str) and next_token == str(fetched):
+                continue
+
+            break
+
+    async def _collect(self, start_time, end_time):
+        events = []
+        async for page in self.iter_events(start_time, end_time):
+            events += page
+
+        return events
+
+    async def get_events(self, start_time=None, end_time=None, slices=1):
+        """
+        :param int slices: split the window into `slices` parts paged concurrently,
+            NextToken paging is sequential within a part
+        """
+        start_time = start_time or Aliapi.get_datetime(6)
+        end_time = end_time or Aliapi.get_datetime()
+        if slices <= 1:
+            return await self._collect(start_time, end_time)
+
+        start, end = (datetime.strptime(t, '%Y-%m-%dT%H:%M:%SZ') for t in (start_time, end_time))
+        step = (end - start) / slices
+        bounds = [start + step * i for i in range(slices)] + [end]
+
+        pages = await asyncio.gather(*(
+            self._collect(Aliapi.format_datetime(bounds[i]), Aliapi.format_datetime(bounds[i + 1]))
+            for i in range(slices)
+        ))
+
+        #: slice bounds are inclusive on both sides
+        events, seen = [], set()
+        for page in pages:
+            for event in page:
+                if event["eventId"] not in seen:
+                    seen.add(event["eventId"])
+                    events.append(event)
+
+        return events
+
+
+async def gather_events(clients, start_time=None, end_time=None, slices=1):
+    """
+    Query several accounts/regions from one event loop.
+    :param clients: list of AsyncAliapi, usually sharing one session
+    :return list: events of each client, in the same order
+    """
+    return await asyncio.gather(*(
+        client.get_events(start_time, end_time, slices=slices) for client in clients
+    ))
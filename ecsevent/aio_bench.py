@@ -0,0 +1,107 @@
+# -*- coding:utf-8 -*-
+"""
+Latency of the blocking Aliapi against AsyncAliapi, both against the offline ActionTrail stub:
+    sync   one Aliapi per account/region, queried one after the other, one request at a time
+    async  one AsyncAliapi per account/region on a shared keep-alive session, gathered on one loop,
+           each window split in --slices parts paged concurrently
+
+    python aio_bench.py --shards 4 --minutes 10 --latency 0.05
+    python aio_bench.py --shards 16 --concurrency 16 --slices 4
+
+Request latency is measured per HTTP request, the wall time covers fetching every shard.
+"""
+import argparse
+import asyncio
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from actiontrail_stub import StubServer
+from ali import Aliapi
+from aio_ali import AsyncAliapi, gather_events
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+class TimedAsyncAliapi(AsyncAliapi):
+
+    def __init__(self, *args, latencies=None, **kwargs):
+        super(TimedAsyncAliapi, self).__init__(*args, **kwargs)
+        self.latencies = latencies
+
+    async def get_request_result(self, action, params):
+        started = time.perf_counter()
+        try:
+            return await super(TimedAsyncAliapi, self).get_request_result(action, params)
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+
+def run_sync(endpoint, shards, start_time, end_time):
+    latencies, events = [], 0
+    started = time.perf_counter()
+    for shard in range(shards):
+        api = Aliapi("bench", "bench", f"bench-{shard}", endpoint=endpoint, rate=100000, burst=100000,
+                     observe=lambda seconds, outcome: latencies.append(seconds))
+        events += len(api.get_events(start_time, end_time))
+    return time.perf_counter() - started, latencies, events
+
+
+def run_async(endpoint, shards, start_time, end_time, concurrency, slices):
+    latencies = []
+
+    async def fetch():
+        session = AsyncAliapi.create_session(limit=concurrency * shards)
+        try:
+            clients = [
+                TimedAsyncAliapi("bench", "bench", f"bench-{shard}", endpoint=f"http://{endpoint}", session=session,
+                                 concurrency=concurrency, latencies=latencies)
+                for shard in range(shards)
+            ]
+            return await gather_events(clients, start_time, end_time, slices=slices)
+        finally:
+            await session.close()
+
+    started = time.perf_counter()
+    results = asyncio.get_event_loop().run_until_complete(fetch())
+    return time.perf_counter() - started, latencies, sum(len(events) for events in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=4, help="accounts/regions queried")
+    parser.add_argument("--minutes", type=int, default=10, help="window per shard")
+    parser.add_argument("--events-per-minute", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stub adds to every page")
+    parser.add_argument("--concurrency", type=int, default=8, help="AsyncAliapi requests in flight per client")
+    parser.add_argument("--slices", type=int, default=4, help="AsyncAliapi parts per window")
+    args = parser.parse_args()
+
+    stub = StubServer(("127.0.0.1", 0), events_per_minute=args.events_per_minute, latency=args.latency)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    start = datetime(2000, 1, 1)
+    start_time, end_time = Aliapi.format_datetime(start), Aliapi.format_datetime(start + timedelta(minutes=args.minutes))
+
+    print(f"{'client':<6} {'seconds':>8} {'requests':>9} {'events':>8} {'latency p50/p99 ms':>19}")
+    results = {
+        "sync": run_sync(stub.endpoint, args.shards, start_time, end_time),
+        "async": run_async(stub.endpoint, args.shards, start_time, end_time, args.concurrency, args.slices),
+    }
+    for name, (seconds, latencies, events) in results.items():
+        print(f"{name:<6} {seconds:>8.3f} {len(latencies):>9} {events:>8} "
+              f"{percentile(latencies, 0.5) * 1000:>9.1f}/{percentile(latencies, 0.99) * 1000:<9.1f}")
+    print(f"async speedup {results['sync'][0] / results['async'][0]:.1f}x")
+
+    stub.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,73 +1,264 @@
 # -*- coding:utf-8 -*-
+import random
+import threading
 import time
+from collections import Counter
 from datetime import datetime, timedelta
 import json
 
 from aliyunsdkactiontrail.request.v20171204 import LookupEventsRequest
 from aliyunsdkcore.acs_exception.exceptions import ClientException, ServerException
 from aliyunsdkcore.client import AcsClient
-from aliyunsdkcore.profile import region_provider
 from aliyunsdkcore.request import RpcRequest
 
+#: error codes / http status the server returns when the API quota is exceeded
+THROTTLING_CODES = {"Throttling", "Throttling.User", "Throttling.Api", "Throttling.Concurrent",
+                    "ServiceUnavailable", "RequestLimitExceeded"}
+THROTTLING_STATUS = {429, 503}
+
+
+def backoff(attempt, base_delay=0.5, max_delay=30):
+    """ exponential backoff with full jitter """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def is_throttled(code, status):
+    """
+    :param str code: error code of the response
+    :param int status: http status of the response
+    """
+    return code in THROTTLING_CODES or status in THROTTLING_STATUS
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket, the rate adapts to throttling (AIMD):
+    halved on every throttled request, raised by `step` on every success.
+    """
+
+    def __init__(self, rate=10.0, burst=10, min_rate=0.5, step=0.1):
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = min_rate
+        self.step = step
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        :return float: seconds waited for a token
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` consecutive transient failures, lets one request
+    through after `reset_timeout` seconds and closes again when it succeeds.
+    Thread safe, the clients of an account/region share it.
+    """
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        #: when the half open probe was let through, None while none is in flight
+        self.probe_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.closed
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.half_open
+        return self.open
+
+    def allow(self):
+        """
+        Half open, only one probe is let through until it records its outcome,
+        another one after `reset_timeout` seconds if it never does.
+        """
+        with self.lock:
+            state = self.state
+            if state != self.half_open:
+                return state == self.closed
+
+            now = time.monotonic()
+            if self.probe_at is not None and now - self.probe_at < self.reset_timeout:
+                return False
+            self.probe_at = now
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe_at = None
+            if self.failures >= self.threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
 
 class Aliapi(object):
+    #: shared by every client of the same account / account and region
+    _buckets = {}
+    _breakers = {}
+    _registry_lock = threading.Lock()
 
-    def __init__(self, ak=None, secret=None, region_id="cn-shenzhen"):
+    def __init__(self, ak=None, secret=None, region_id="cn-shenzhen", endpoint=None,
+                 rate=10, burst=10, max_retries=5, base_delay=0.5, max_delay=30, observe=None):
         """
         :param ak: access key
         :param secret: access secret
-        :param region_id: only cn-shenzhen
+        :param region_id: region of the trail, e.g. cn-shenzhen, one client per region
+        :param endpoint: override the ActionTrail endpoint, e.g. a local stub "127.0.0.1:8089"
+        :param rate: requests per second allowed for the account
+        :param burst: token bucket size
+        :param max_retries: retries of throttled/timed out requests
+        :param base_delay: first backoff delay in seconds
+        :param max_delay: backoff cap in seconds
+        :param observe: called with (seconds, outcome) after every attempt,
+                        outcome is ok, throttled, timeout or error
         """
         self.region_id = region_id
         self.client = AcsClient(ak, secret, region_id)
 
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        #: requests, retries, throttled, failed, rejected, waited (seconds)
+        self.stats = Counter()
+        self.observe = observe
+
+        with self._registry_lock:
+            self.bucket = self._buckets.setdefault(ak, TokenBucket(rate, burst))
+            self.breaker = self._breakers.setdefault((ak, region_id), CircuitBreaker())
+
+        if endpoint:
+            #: on this client only, region_provider.modify_point would redirect every client of the process
+            self.client.add_endpoint(region_id, 'Actiontrail', endpoint)
+
         # region_provider.modify_point('BssOpenApi', 'cn-shenzhen', 'business.aliyuncs.com')
 
     def get_request_result(self, request):
         if not isinstance(request, RpcRequest):
             raise TypeError("request is not valid RpcRequest")
 
-        try:
-            response = self.client.do_action_with_exception(request)
-        except ClientException as err:
-            if "timed out" in err.message:
-                time.sleep(2)
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            raise ValueError(f"circuit open for actiontrail {self.region_id}")
 
+        attempt = 0
+        while True:
+            self.stats["waited"] += self.bucket.acquire()
+            self.stats["requests"] += 1
+            started = time.monotonic()
+            try:
                 response = self.client.do_action_with_exception(request)
-            else:
-                raise ValueError(err)
-        except ServerException as err:
-            raise ValueError(err)
+            except (ClientException, ServerException) as err:
+                throttled = self.is_throttled(err)
+                timeout = not throttled and self.is_timeout(err)
+                self._observe(started, "throttled" if throttled else "timeout" if timeout else "error")
+                if not (throttled or timeout):
+                    raise ValueError(err)
 
-        return response
+                self.breaker.record_failure()
+                if throttled:
+                    self.stats["throttled"] += 1
+                    self.bucket.slow_down()
+                if attempt >= self.max_retries or not self.breaker.allow():
+                    self.stats["failed"] += 1
+                    raise ValueError(err)
 
-    def get_events(self, start_time=None, end_time=None):
-        events = []
+                delay = self.backoff(attempt)
+                self.stats["retries"] += 1
+                self.stats["waited"] += delay
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self._observe(started, "ok")
+            self.breaker.record_success()
+            self.bucket.speed_up()
+            return response
+
+    def _observe(self, started, outcome):
+        if self.observe is not None:
+            self.observe(time.monotonic() - started, outcome)
+
+    def backoff(self, attempt):
+        return backoff(attempt, self.base_delay, self.max_delay)
+
+    @staticmethod
+    def is_throttled(err):
+        if isinstance(err, ServerException):
+            return is_throttled(err.get_error_code(), err.get_http_status())
+        return False
+
+    @staticmethod
+    def is_timeout(err):
+        return isinstance(err, ClientException) and "timed out" in str(err.message)
+
+    def iter_events(self, start_time=None, end_time=None, max_results=50):
+        """
+        Yield LookupEvents results one page (list of events) at a time.
+        :param str start_time: defaults to 6 minutes ago
+        :param str end_time: defaults to now
+        :param int max_results: events per page
+        """
+        start_time = start_time or self.get_datetime(6)
+        end_time = end_time or self.get_datetime()
         next_token = None
+        fetched = 0
 
-        def _request(max_results=50):
+        while True:
             request = LookupEventsRequest.LookupEventsRequest()
-            request.set_query_params({
-                "MaxResults": max_results,
-                "StartTime": start_time if start_time else self.get_datetime(6),
-                "EndTime": end_time if end_time else self.get_datetime()
-            })
-
+            request.set_query_params({"MaxResults": max_results, "StartTime": start_time, "EndTime": end_time})
             if next_token:
                 request.add_query_param("NextToken", next_token)
 
-            return request
-
-        while True:
-            result = json.loads(self.get_request_result(_request()))
-            events += result["Events"]
+            result = json.loads(self.get_request_result(request))
+            fetched += len(result["Events"])
+            yield result["Events"]
 
             next_token = result.get("NextToken")
-            if isinstance(next_token, str) and next_token == str(len(events)):
+            if isinstance(next_token, str) and next_token == str(fetched):
                 continue
 
             break
 
+    def get_events(self, start_time=None, end_time=None):
+        events = []
+        for page in self.iter_events(start_time, end_time):
+            events += page
+
         return events
 
     @classmethod
@@ -76,4 +267,12 @@ class Aliapi(object):
         if isinstance(offset, int):
             now = now - timedelta(minutes=offset)
 
-        return now.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return cls.format_datetime(now)
+
+    @staticmethod
+    def format_datetime(dt):
+        """
+        :param datetime dt: naive UTC datetime
+        :return str: ActionTrail time format
+        """
+        return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -0,0 +1,32 @@
+# -*- coding:utf-8 -*-
+import pytest
+
+
+@pytest.fixture
+def app(tmpdir):
+    """ App on a throwaway SQLite file, the local cache and no configured shards """
+    from ecs import App, cache, db, init_api
+
+    app = App("ecs")
+    app.config.from_object("ecs.config.AppConfig")
+    app.config.update(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmpdir.join('ecs.db')}", SQLALCHEMY_TRACK_MODIFICATIONS=False,
+                      CACHE_TYPE="simple", SRV={}, TESTING=True)
+    db.init_app(app)
+    cache.init_app(app)
+    init_api(app)
+
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def redis():
+    """ fakeredis connection, the tests that need it are skipped without fakeredis """
+    fakeredis = pytest.importorskip("fakeredis")
+    connection = fakeredis.FakeStrictRedis()
+    connection.flushall()
+    yield connection
+    connection.flushall()
@@ -0,0 +1,54 @@
+# -*- coding:utf-8 -*-
+"""
+Cost of resolving the task module of a job, the part of `ecs.tasks.run` in front of the task itself:
+    load_module  the file executed again on every job, the path the worker used before
+    get_module   the module cached per worker, reloaded only when its file changed
+
+    python dispatch_bench.py --jobs 200
+    python dispatch_bench.py --modules cron --jobs 1000
+
+The first load of each module (the SDK import included) is done before timing, as preload_modules does.
+"""
+import argparse
+import sys
+import time
+
+
+def timed(resolve, modules, jobs):
+    """
+    :return float: microseconds per job
+    """
+    started = time.perf_counter()
+    for index in range(jobs):
+        resolve(modules[index % len(modules)])
+    return (time.perf_counter() - started) / jobs * 1e6
+
+
+def main():
+    from ecs import tasks
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=None, help="task modules, defaults to all")
+    parser.add_argument("--jobs", type=int, default=200, help="jobs dispatched per path")
+    args = parser.parse_args()
+
+    modules = args.modules or tasks.task_list()
+    tasks.preload_modules()
+
+    paths = {
+        "load_module": lambda mn: tasks.load_module(mn, f"{tasks.absolute_path()}/{mn}.py"),
+        "get_module": tasks.get_module,
+    }
+    print(f"modules {', '.join(modules)}, {args.jobs} jobs")
+    print(f"{'path':<12} {'us/job':>12} {'jobs/s':>12}")
+    result = {}
+    for name, resolve in paths.items():
+        result[name] = timed(resolve, modules, args.jobs)
+        print(f"{name:<12} {result[name]:>12.1f} {1e6 / result[name]:>12.0f}")
+    print(f"get_module speedup {result['load_module'] / result['get_module']:.0f}x")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
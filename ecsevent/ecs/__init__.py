@@ -4,20 +4,21 @@ import os
 import sys
 import yaml
 from flask_caching import Cache
-from flask_migrate import Migrate
 from datetime import date, datetime, timedelta
 from decimal import Decimal
 from ipaddress import IPv4Address
 from sqlalchemy.ext.associationproxy import _AssociationList
 
-from ecs.event_model import db
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from ecs.event_model import db, chunks
 from flask import g, json, request as current_request, Response, current_app, Flask, Config
-from ecs import tasks
 
 __all__ = ["cache", "create_app", "current_app", "g", "db", "current_request"]
 
-from ecs.tasks import rq
-
 cache = Cache()
 
 
@@ -27,8 +28,10 @@ def create_app(config_path=None):
 
     init_config(app, config_path)
     init_database(app)
+    init_api(app)
 
-    #: init cache
+    #: init cache, on the RQ Redis unless configured otherwise
+    app.config.setdefault("CACHE_REDIS_URL", app.config.get("RQ_REDIS_URL", "redis://localhost:6379/0"))
     cache.init_app(app)
     init_rq(app)
 
@@ -58,13 +61,27 @@ def init_config(app, config_path):
 
 
 def init_database(app):
+    #: alembic is the slowest import of the app, only paid when an app is built
+    from flask_migrate import Migrate
+
     db.init_app(app)
     db.app = app
 
     Migrate(app, db)
 
 
+def init_api(app):
+    from ecs.api import events_api, sync_api, metrics_api
+
+    app.register_blueprint(events_api)
+    app.register_blueprint(sync_api)
+    app.register_blueprint(metrics_api)
+
+
 def init_rq(app):
+    #: rq and the scheduler load with the first app, not with the package
+    from ecs import tasks
+
     tasks.rq.init_app(app)
 
     # default_queue = rq.get_queue()
@@ -75,8 +92,13 @@ def init_rq(app):
     #
     # scheduler = rq.get_scheduler(interval=10)
     # scheduler.run()
-    tasks.run.cron("* * * * *", "aliyun sync_events", mn="cron", fn="sync_aliyun_events")
-    # tasks.run.schedule(timedelta(seconds=1), repeat=None, interval=20, mn="cron", fn="sync_aliyun_events")
+    if not app.config["SYNC_SCHEDULES_ON_START"]:
+        return
+
+    from ecs.schedules import sync_schedules
+
+    #: idempotent, periodic jobs are declared in ecs.schedules.SCHEDULES
+    sync_schedules()
 
 
 class LoadAppConfig(Config):
@@ -96,22 +118,32 @@ class LoadAppConfig(Config):
 
 
 class AppJSONEncoder(json.JSONEncoder):
-    _needs_to_process = (set, datetime, timedelta, date, Decimal, _AssociationList, IPv4Address)
+    #: exact type -> conversion, one dict lookup per object instead of an isinstance chain
+    encoders = {
+        datetime: lambda obj: obj.strftime("%Y-%m-%d %H:%M:%S"),
+        timedelta: lambda obj: obj.seconds,
+        date: lambda obj: obj.strftime("%Y-%m-%d"),
+        Decimal: int,
+        _AssociationList: list,
+        set: list,
+        IPv4Address: str,
+    }
+
+    @classmethod
+    def convert(cls, obj):
+        """ `default` of the orjson backend, same output as the stdlib one """
+        encoder = cls.encoders.get(type(obj))
+        if encoder is not None:
+            return encoder(obj)
+        if callable(obj):
+            return str(obj)
+
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
     def default(self, obj):
-        if type(obj) in self._needs_to_process:
-            if isinstance(obj, datetime):
-                return obj.strftime("%Y-%m-%d %H:%M:%S")
-            if isinstance(obj, timedelta):
-                return obj.seconds
-            if isinstance(obj, date):
-                return obj.strftime("%Y-%m-%d")
-            if isinstance(obj, Decimal):
-                return int(obj)
-            if isinstance(obj, (_AssociationList, set)):
-                return list(obj)
-            if isinstance(obj, IPv4Address):
-                return str(obj)
+        encoder = self.encoders.get(type(obj))
+        if encoder is not None:
+            return encoder(obj)
         elif callable(obj):
             return str(obj)
 
@@ -139,8 +171,10 @@ class AppResponse(Response):
         super(Response, self).__init__(content, *args, **kargs)
 
     @staticmethod
-    def to_json(content):
-        """Converts content to json while respecting config.yml options."""
+    def json_options():
+        """
+        :return tuple: (indent, separators, sort_keys) from config.yml
+        """
         indent = None
         separators = (',', ':')
 
@@ -148,7 +182,47 @@ class AppResponse(Response):
             indent = 4
             separators = (', ', ': ')
 
-        return json.dumps(content, indent=indent, separators=separators, cls=AppJSONEncoder)
+        return indent, separators, current_app.config.get('JSON_SORT_KEYS', True)
+
+    @staticmethod
+    def dumps(content, indent=None, separators=(',', ':'), sort_keys=True):
+        """
+        :return bytes|str: orjson when installed and the output is compact, stdlib otherwise
+        """
+        if orjson is not None and indent is None:
+            option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(content, default=AppJSONEncoder.convert, option=option)
+
+        return json.dumps(content, indent=indent, separators=separators, sort_keys=sort_keys, cls=AppJSONEncoder)
+
+    @classmethod
+    def to_json(cls, content):
+        """Converts content to json while respecting config.yml options."""
+        return cls.dumps(content, *cls.json_options())
+
+    @classmethod
+    def stream_json(cls, items, chunk_size=500):
+        """
+        Stream an iterable as a JSON list, encoded `chunk_size` items at a time.
+        Wrap `items` with flask.stream_with_context when it reads the database.
+        """
+        sort_keys = current_app.config.get('JSON_SORT_KEYS', True)
+
+        def encode(item):
+            data = cls.dumps(item, sort_keys=sort_keys)
+            return data if isinstance(data, bytes) else data.encode()
+
+        def generate():
+            yield b"["
+            separator = b""
+            for chunk in chunks(items, chunk_size):
+                yield separator + b",".join(encode(item) for item in chunk)
+                separator = b","
+            yield b"]"
+
+        return cls(generate(), mimetype='application/json')
 
     @classmethod
     def force_type(cls, response, environ=None):
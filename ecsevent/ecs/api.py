@@ -0,0 +1,163 @@
+# -*- coding:utf-8 -*-
+import base64
+from datetime import datetime
+
+from flask import Blueprint, request as current_request, stream_with_context
+
+from ecs import AppResponse, current_app, event_cache, metrics
+from ecs.event_model import AliEvent, AliEventRollup, SyncCheckpoint
+from ecs.tasks import rq
+
+__all__ = ["events_api", "sync_api", "metrics_api"]
+
+events_api = Blueprint("events", __name__, url_prefix="/api/events")
+sync_api = Blueprint("sync", __name__, url_prefix="/api/sync")
+metrics_api = Blueprint("metrics", __name__)
+
+TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d")
+MAX_LIMIT = 1000
+
+
+def parse_time(value):
+    """
+    :param str value: local time, same format as AppJSONEncoder output
+    """
+    if not value:
+        return None
+
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"invalid time: {value}")
+
+
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+
+    request_time, event_id = cursor
+    return base64.urlsafe_b64encode(f"{request_time:%Y-%m-%d %H:%M:%S.%f}|{event_id}".encode()).decode()
+
+
+def decode_cursor(value):
+    if not value:
+        return None
+
+    try:
+        request_time, event_id = base64.urlsafe_b64decode(value.encode()).decode().split("|", 1)
+        return datetime.strptime(request_time, "%Y-%m-%d %H:%M:%S.%f"), event_id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"invalid cursor: {value}")
+
+
+def search_args(args):
+    """
+    :param args: query string, start_time, end_time, cursor, limit and AliEvent.filters
+    :return dict: kwargs of AliEvent.search
+    """
+    kwargs = {name: args.get(name) for name in AliEvent.filters if args.get(name) is not None}
+    kwargs["start_time"] = parse_time(args.get("start_time"))
+    kwargs["end_time"] = parse_time(args.get("end_time"))
+    kwargs["after"] = decode_cursor(args.get("cursor"))
+    limit = int(args.get("limit", 100))
+    if limit < 1:
+        raise ValueError(f"invalid limit: {limit}")
+    kwargs["limit"] = min(limit, MAX_LIMIT)
+
+    return kwargs
+
+
+@events_api.route("", methods=["GET"])
+def list_events():
+    try:
+        kwargs = search_args(current_request.args)
+    except ValueError as err:
+        return dict(status=400, message=str(err))
+
+    def load():
+        events, cursor = AliEvent.search(**kwargs)
+        return dict(events=[event.to_dict() for event in events], cursor=encode_cursor(cursor))
+
+    return event_cache.cached("events", kwargs, load)
+
+
+@events_api.route("/export", methods=["GET"])
+def export_events():
+    """ every matching event as one streamed JSON list, read page by page """
+    try:
+        kwargs = search_args(current_request.args)
+    except ValueError as err:
+        return dict(status=400, message=str(err))
+    kwargs["limit"] = MAX_LIMIT
+
+    def generate():
+        while True:
+            events, kwargs["after"] = AliEvent.search(**kwargs)
+            for event in events:
+                yield event.to_dict()
+            if kwargs["after"] is None:
+                break
+
+    return AppResponse.stream_json(stream_with_context(generate()))
+
+
+@events_api.route("/counts", methods=["GET"])
+def count_events():
+    args = current_request.args
+    group_by = tuple(args.get("group_by", "service_name").split(","))
+    try:
+        kwargs = dict(start_time=parse_time(args.get("start_time")), end_time=parse_time(args.get("end_time")))
+        filters = {name: args[name] for name in AliEventRollup.dimensions if name in args}
+        if "failed" in filters:
+            filters["failed"] = filters["failed"] in ("1", "true")
+        if not set(group_by) <= set(AliEventRollup.dimensions):
+            raise ValueError(f"invalid group_by: {','.join(group_by)}")
+    except ValueError as err:
+        return dict(status=400, message=str(err))
+
+    return event_cache.cached(
+        "counts", dict(kwargs, group_by=group_by, **filters),
+        lambda: dict(counts=AliEventRollup.totals(group_by=group_by, **kwargs, **filters))
+    )
+
+
+@events_api.route("/cache", methods=["GET"])
+def cache_stats():
+    return dict(event_cache.stats, generation=event_cache.generation())
+
+
+@events_api.route("/<event_id>", methods=["GET"])
+def get_event(event_id):
+    event = AliEvent.query.filter_by(id=event_id).first()
+    if event is None:
+        return dict(status=404, message=f"event {event_id} not found")
+
+    return event.to_dict()
+
+
+@sync_api.route("/shards", methods=["GET"])
+def shard_health():
+    from ecs.tasks.aliyun import Aliyun
+
+    config = (current_app.config.get("SRV") or {}).get("ALIYUN")
+    if not config:
+        return dict(shards=[], max_lag=None)
+
+    shards = SyncCheckpoint.report(Aliyun.shards(config))
+    lags = [shard["lag"] for shard in shards if shard["lag"] is not None]
+    return dict(shards=shards, max_lag=max(lags) if lags else None)
+
+
+@metrics_api.route("/metrics", methods=["GET"])
+def export_metrics():
+    now = datetime.utcnow()
+    metrics.sync_lag_seconds.clear()
+    for checkpoint in SyncCheckpoint.query:
+        lag = checkpoint.lag(now)
+        if lag is not None:
+            metrics.sync_lag_seconds.set(lag, account=checkpoint.account, region_id=checkpoint.region_id)
+
+    metrics.flush(rq.connection)
+    return AppResponse(metrics.render(rq.connection), content_type=metrics.CONTENT_TYPE)
@@ -37,3 +37,39 @@ class AppConfig(object):
 
     #: This will print all SQL statements
     SQLALCHEMY_ECHO = False
+
+    #: scheduler with pipelined writes and the description index, see ecs.tasks.Scheduler
+    RQ_SCHEDULER_CLASS = 'ecs.tasks.Scheduler'
+
+    #: write ecs.schedules.SCHEDULES to Redis in create_app, off so that the CLI and workers
+    #: start without touching Redis, deploys run `flask schedules --sync` instead
+    SYNC_SCHEDULES_ON_START = False
+
+    #: single-flight lease of each account/region sync, policy is "skip" or "coalesce", see ecs.lease
+    SYNC_LEASE_POLICY = "coalesce"
+    SYNC_LEASE_TTL = 60
+
+    #: account/region shards syncing at once across all workers, a shard waits
+    #: SYNC_SLOT_WAIT seconds for a slot before it is deferred to the next run
+    SYNC_MAX_SHARDS = 8
+    SYNC_SLOT_WAIT = 30
+
+    #: local write-ahead spool between the sync and ali_event, off while None, see ecs.spool
+    #: the sync appends fetched pages and keeps its checkpoint in Redis, then drains the spool of its host
+    EVENT_SPOOL_DIR = None
+    EVENT_SPOOL_SEGMENT_BYTES = 64 * 1024 * 1024
+    EVENT_SPOOL_BATCH = 5000
+
+    #: ali_event monthly partitions, see ecs.partition
+    EVENT_RETENTION_DAYS = 365
+    EVENT_PARTITIONS_AHEAD = 3
+
+    #: seconds an event read stays cached, sync invalidates earlier, see ecs.event_cache
+    EVENT_CACHE_TIMEOUT = 300
+
+    #: the worker bumps the event cache generation and the web processes must see it,
+    #: so event reads are only cached on a shared backend: set CACHE_TYPE to redis in config.yml
+    #: (APP) or the environment, CACHE_REDIS_URL defaults to RQ_REDIS_URL;
+    #: with the default null backend (or simple...) event reads are not cached and no Redis is needed
+    CACHE_TYPE = os.environ.get("CACHE_TYPE", "null")
+    CACHE_KEY_PREFIX = "ecs:cache:"
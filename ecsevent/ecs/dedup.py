@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+from collections import OrderedDict
+
+from ecs.event_model import AliEvent
+
+__all__ = ["EventDeduper", "deduper"]
+
+
+class EventDeduper(object):
+    """
+    Bounded LRU of recently stored event ids, misses fall back to one
+    `id IN (...)` query per batch, so a sync costs O(batch) instead of O(table).
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, event_id):
+        if event_id in self.ids:
+            self.ids.move_to_end(event_id)
+            return True
+        return False
+
+    def add(self, event_ids):
+        for event_id in event_ids:
+            self.ids[event_id] = None
+            self.ids.move_to_end(event_id)
+
+        while len(self.ids) > self.capacity:
+            self.ids.popitem(last=False)
+
+    def warm(self, since):
+        """
+        :param datetime since: load the ids stored from this request_time on, naive local time
+        """
+        self.add(AliEvent.recent_ids(since))
+        return len(self.ids)
+
+    def filter_new(self, events):
+        """
+        :param events: converted events, see Aliyun.conv_event
+        :return list: the events not stored yet, without duplicates inside the batch
+        """
+        unknown = []
+        for event in events:
+            if event["id"] in self:
+                self.hits += 1
+            else:
+                unknown.append(event)
+
+        existing = AliEvent.existing_ids({event["id"] for event in unknown})
+        self.misses += len(unknown)
+        self.add(existing)
+
+        new, seen = [], set(existing)
+        for event in unknown:
+            if event["id"] not in seen:
+                seen.add(event["id"])
+                new.append(event)
+
+        return new
+
+
+#: shared by every sync in the worker process
+deduper = EventDeduper()
@@ -0,0 +1,77 @@
+# -*- coding:utf-8 -*-
+import hashlib
+import json
+from collections import Counter
+from datetime import date, datetime
+
+from ecs import cache, current_app
+
+__all__ = ["cached", "bump_generation", "generation", "shared", "stats"]
+
+GENERATION_KEY = "ali_event:generation"
+
+#: backends private to a process, a generation bumped by the worker never reaches the web process
+LOCAL_CACHE_TYPES = ("null", "simple", "filesystem", "uwsgi", "NullCache", "SimpleCache", "FileSystemCache")
+
+#: hits / misses of this process
+stats = Counter()
+
+
+def generation():
+    """
+    :return int: bumped by every sync that writes events, part of every cache key
+    """
+    value = cache.get(GENERATION_KEY)
+    if value is None:
+        cache.add(GENERATION_KEY, 1, timeout=0)
+        value = cache.get(GENERATION_KEY) or 1
+
+    return int(value)
+
+
+def bump_generation():
+    """ Invalidate every cached event read at once. """
+    backend = cache.cache
+    if backend.inc(GENERATION_KEY) is None:
+        backend.set(GENERATION_KEY, generation() + 1, timeout=0)
+
+
+def shared():
+    """
+    :return bool: every process sees the same cache, required for the generation to invalidate
+    """
+    return current_app.config.get("CACHE_TYPE", "null") not in LOCAL_CACHE_TYPES
+
+
+def normalize(params):
+    def default(obj):
+        if isinstance(obj, (datetime, date)):
+            return obj.isoformat()
+        return str(obj)
+
+    params = {name: value for name, value in params.items() if value is not None}
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=default).encode()).hexdigest()
+
+
+def cached(namespace, params, loader, timeout=None):
+    """
+    :param str namespace: kind of read, e.g. "events"
+    :param dict params: query parameters, normalized into the key
+    :param loader: called on a miss, must return something the cache can serialize
+    :param int timeout: defaults to EVENT_CACHE_TIMEOUT
+    """
+    if not shared():
+        #: could serve pages older than the last sync
+        stats["bypassed"] += 1
+        return loader()
+
+    key = f"ali_event:{generation()}:{namespace}:{normalize(params)}"
+    value = cache.get(key)
+    if value is not None:
+        stats["hits"] += 1
+        return value
+
+    stats["misses"] += 1
+    value = loader()
+    cache.set(key, value, timeout=timeout or current_app.config["EVENT_CACHE_TIMEOUT"])
+    return value
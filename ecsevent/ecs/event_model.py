@@ -1,16 +1,191 @@
 # -*- coding:utf-8 -*-
 import datetime
+import hashlib
+import json
+from collections import Counter
+from itertools import islice
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy_utils import JSONType
+from sqlalchemy import DDL, UnicodeText, and_, or_, bindparam, event as sa_event, text
+from sqlalchemy.types import TypeDecorator
 
-__all__ = ["AliEvent", "db"]
+__all__ = [
+    "AliEvent", "AliIdentity", "AliUserAgent", "AliService", "AliEventRollup", "SyncCheckpoint", "BackfillWindow", "db"
+]
 
 db = SQLAlchemy()
 
 
+class JSONType(TypeDecorator):
+    """
+    JSON as text, stored like sqlalchemy_utils.JSONType of the migrations on MySQL and SQLite,
+    without importing sqlalchemy_utils, which loads every SQLAlchemy dialect.
+    """
+    impl = UnicodeText
+    hashable = False
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else json.dumps(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else json.loads(value)
+
+
+def mysql_insert(table):
+    """ INSERT ... ON DUPLICATE KEY UPDATE, the MySQL dialect is loaded on the first MySQL write """
+    from sqlalchemy.dialects.mysql import insert
+
+    return insert(table)
+
+
+def chunks(iterable, size):
+    """
+    :param iterable: rows
+    :param int size: chunk size
+    :return: generator of lists with at most `size` rows
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Dimension(object):
+    """
+    Dictionary table of a value repeated across ali_event rows, keyed by a 64-bit hash of the value,
+    so a key is known without a round trip and every process computes the same one.
+    ali_event keeps the key only, there is no foreign key constraint since ali_event is partitioned.
+    """
+    #: name of the value column, same as the ali_event column it replaces
+    column = None
+    #: ali_event column holding the key
+    key_column = None
+    #: the cache is dropped when it outgrows this, dimensions are expected to stay small
+    max_cache = 100000
+
+    @classmethod
+    def canonical(cls, value):
+        return value
+
+    @classmethod
+    def key_of(cls, value):
+        """
+        :return int: signed 64-bit key of `value`, None for None
+        """
+        if value is None:
+            return None
+        digest = hashlib.blake2b(cls.canonical(value).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+    @classmethod
+    def remember(cls, values):
+        """
+        :param dict values: key -> value
+        """
+        if len(cls.cache) + len(values) > cls.max_cache:
+            cls.cache.clear()
+        cls.cache.update(values)
+
+    @classmethod
+    def resolve(cls, values):
+        """
+        Keys of `values`, the ones new to this process are written first, in their own transaction,
+        so the keys are never cached for rows a rollback removed.
+        :param list values: values or None
+        :return list: keys, in the order of `values`
+        """
+        keys = [cls.key_of(value) for value in values]
+        missing = {key: value for key, value in zip(keys, values) if key is not None and key not in cls.cache}
+        if missing:
+            table = cls.__table__
+            prefix = "IGNORE" if db.engine.dialect.name == "mysql" else "OR IGNORE"
+            try:
+                for chunk in chunks(missing.items(), 500):
+                    db.session.execute(table.insert().prefix_with(prefix),
+                                       [{"id": key, cls.column: value} for key, value in chunk])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            cls.remember(missing)
+
+        return keys
+
+    @classmethod
+    def values(cls, keys):
+        """
+        :param keys: keys, None is skipped
+        :return dict: key -> value, keys without a row are left out
+        """
+        keys = {key for key in keys if key is not None}
+        missing = keys - cls.cache.keys()
+        loaded = {}
+        for chunk in chunks(missing, 1000):
+            loaded.update(db.session.query(cls.id, getattr(cls, cls.column)).filter(cls.id.in_(chunk)))
+        if loaded:
+            cls.remember(loaded)
+
+        found = {key: cls.cache[key] for key in keys if key in cls.cache}
+        found.update(loaded)
+        return found
+
+
+class AliIdentity(Dimension, db.Model):
+    __tablename__ = "ali_identity"
+    column = "identity"
+    key_column = "identity_key"
+    cache = {}
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    #: ActionTrail userIdentity
+    identity = db.Column(JSONType)
+
+    @classmethod
+    def canonical(cls, value):
+        return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+class AliUserAgent(Dimension, db.Model):
+    __tablename__ = "ali_user_agent"
+    column = "user_agent"
+    key_column = "user_agent_key"
+    cache = {}
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    #: 发送 API 请求的客户端代理标识，比如控制台为 AliyunConsole ，SDK 为 aliyuncli/2.0.6 。
+    user_agent = db.Column(db.String(255))
+
+
+class AliService(Dimension, db.Model):
+    __tablename__ = "ali_service"
+    column = "service_name"
+    key_column = "service_key"
+    cache = {}
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    #: 云服务名称，如 Ecs, Rds, Ram。
+    service_name = db.Column(db.String(64))
+
+
 class AliEvent(db.Model):
     __tablename__ = "ali_event"
+    #: every filter index ends with (request_time, id) to serve the keyset order
+    __table_args__ = (
+        db.Index("ix_ali_event_time", "request_time", "id"),
+        db.Index("ix_ali_event_service_time", "service_key", "request_time", "id"),
+        db.Index("ix_ali_event_name_time", "name", "request_time", "id"),
+        db.Index("ix_ali_event_user_time", "created_by", "request_time", "id"),
+        db.Index("ix_ali_event_ip_time", "source_ip", "request_time", "id"),
+        db.Index("ix_ali_event_err_time", "err_code", "request_time", "id"),
+    )
+
+    #: columns accepted by `search` as equality filters
+    filters = ("service_name", "name", "created_by", "source_ip", "err_code")
+    #: event field -> dictionary table storing it, the row keeps the key
+    encoded = {"service_name": AliService, "user_agent": AliUserAgent, "identity": AliIdentity}
 
     #: 事件ID，由 ActionTrail 服务为每个操作事件所产生的一个GUID。
     id = db.Column(db.String(64), primary_key=True)
@@ -19,7 +194,8 @@ class AliEvent(db.Model):
     #: 处理 API 请求的服务端，比如 ram.aliyuncs.com 。
     source = db.Column(db.String(255))
     #: API 请求的发生时间 - UTC
-    request_time = db.Column(db.DateTime, nullable=False, default=datetime.datetime.now)
+    #: -> 主键包含分区字段 request_time，见 ecs.partition
+    request_time = db.Column(db.DateTime, primary_key=True, default=datetime.datetime.now)
     #: 事件类型，如 ApiCall（控制台或 API 操作）, ConsoleSignin（用户登录）。
     type = db.Column(db.String(255))
     #: ActionTrail 事件格式的版本。
@@ -32,16 +208,17 @@ class AliEvent(db.Model):
     request_id = db.Column(db.String(64), default="")
     #: optional | 用户 API 请求的输入参数
     request_param = db.Column(JSONType, default={})
-    #: 云服务名称，如 Ecs, Rds, Ram。
-    service_name = db.Column(db.String(64))
+    #: 云服务名称 -> ali_service.id
+    service_key = db.Column(db.BigInteger)
     #: 发送API请求的源IP地址。如果API请求是由用户通过控制台操作触发，
     #: -> 那么这里记录的是用户浏览器端的IP地址，而不是控制台Web服务器的IP地址。
-    source_ip = db.Column(db.CHAR(64))
-    #: 发送 API 请求的客户端代理标识，比如控制台为 AliyunConsole ，SDK 为 aliyuncli/2.0.6 。
-    user_agent = db.Column(db.CHAR(255))
-    identity = db.Column(JSONType)
+    source_ip = db.Column(db.String(64))
+    #: 客户端代理标识 -> ali_user_agent.id
+    user_agent_key = db.Column(db.BigInteger)
+    #: 操作者身份 -> ali_identity.id
+    identity_key = db.Column(db.BigInteger)
 
-    created_by = db.Column(db.CHAR(128), nullable=False, default="unknow")
+    created_by = db.Column(db.String(128), nullable=False, default="unknow")
 
     @classmethod
     def get(cls):
@@ -49,13 +226,236 @@ class AliEvent(db.Model):
         return events
 
     @classmethod
-    def get_id(cls):
-        event_ids = cls.query.with_entities(cls.id).all()
-        return event_ids
+    def search(cls, start_time=None, end_time=None, after=None, limit=100, **filters):
+        """
+        Newest first, keyset paginated on (request_time, id), so every page costs the same.
+        :param datetime start_time: request_time >= start_time
+        :param datetime end_time: request_time < end_time
+        :param tuple after: (request_time, id) of the last event of the previous page
+        :param int limit: page size
+        :param filters: equality filters, see `AliEvent.filters`
+        :return tuple: (events, (request_time, id) of the last event or None when there is no next page)
+        """
+        query = cls.query
+        for name, value in filters.items():
+            if name not in cls.filters:
+                raise ValueError(f"invalid filter: {name}")
+            if value is None:
+                continue
+            dimension = cls.encoded.get(name)
+            if dimension is not None:
+                query = query.filter(getattr(cls, dimension.key_column) == dimension.key_of(value))
+            else:
+                query = query.filter(getattr(cls, name) == value)
+
+        if start_time:
+            query = query.filter(cls.request_time >= start_time)
+        if end_time:
+            query = query.filter(cls.request_time < end_time)
+        if after:
+            query = query.filter(or_(
+                cls.request_time < after[0],
+                and_(cls.request_time == after[0], cls.id < after[1])
+            ))
+
+        events = query.order_by(cls.request_time.desc(), cls.id.desc()).limit(limit + 1).all()
+        cls.preload(events)
+        if len(events) > limit:
+            events = events[:limit]
+            return events, (events[-1].request_time, events[-1].id)
+
+        return events, None
+
+    @classmethod
+    def preload(cls, events):
+        """
+        Load the dictionary values of a page of events with one query per dimension, for `to_dict`.
+        """
+        for dimension in cls.encoded.values():
+            dimension.values(getattr(event, dimension.key_column) for event in events)
+
+    def to_dict(self):
+        """
+        :return dict: the event as stored before dictionary encoding, same shape as ali_event_view
+        """
+        data = {column.name: getattr(self, column.name) for column in self.__table__.columns}
+        for name, dimension in self.encoded.items():
+            key = data.pop(dimension.key_column)
+            data[name] = dimension.values([key]).get(key)
+        return data
+
+    @classmethod
+    def encode(cls, events):
+        """
+        :param list events: converted events, see Aliyun.conv_event
+        :return list: copies with the dictionary encoded fields replaced by their keys
+        """
+        events = [dict(event) for event in events]
+        for name, dimension in cls.encoded.items():
+            keys = dimension.resolve([event.pop(name, None) for event in events])
+            for event, key in zip(events, keys):
+                event[dimension.key_column] = key
+        return events
+
+    @staticmethod
+    def stored_bytes(column):
+        """
+        :return: SQL expression, bytes of the stored text, LENGTH counts characters outside MySQL
+        """
+        if db.engine.dialect.name == "mysql":
+            return db.func.length(column)
+        return db.func.length(db.cast(column, db.LargeBinary))
+
+    @classmethod
+    def charset_maxlen(cls):
+        """
+        :return int: bytes per character of the charset of the ali_event text columns, MySQL only
+        """
+        return db.session.execute(text(
+            "SELECT cs.maxlen FROM information_schema.columns c "
+            "JOIN information_schema.character_sets cs ON cs.character_set_name = c.character_set_name "
+            "WHERE c.table_schema = DATABASE() AND c.table_name = :table AND c.column_name = 'created_by'"
+        ), {"table": cls.__tablename__}).scalar() or 4
+
+    @classmethod
+    def storage_report(cls):
+        """
+        Bytes the dictionary encoding saves on ali_event, measured on the stored values with LENGTH().
+        Before, every row carried its identity JSON text, CHAR(255) user_agent, CHAR(64) source_ip,
+        service name and CHAR(128) created_by; after, three 8 byte keys, VARCHAR source_ip and
+        created_by and one copy of each distinct value in the dictionary tables.
+        On MySQL a CHAR(n) takes n bytes with a single byte charset and at least n (InnoDB) with a
+        multibyte one, a VARCHAR 1 or 2 length bytes; SQLite does not pad CHAR.
+        :return dict: rows, per column before/after bytes, totals and, on MySQL, on-disk table sizes
+        """
+        rows = cls.query.count()
+        #: widths of the CHAR columns before the encoding
+        widths = {"user_agent": 255, "source_ip": 64, "created_by": 128}
+        mysql = db.engine.dialect.name == "mysql"
+        maxlen = cls.charset_maxlen() if mysql else 1
+
+        def char_bytes(name, stored):
+            """ bytes a value of `stored` unpadded bytes took in the CHAR column `name` """
+            if name not in widths or not mysql:
+                return stored
+            return widths[name] if maxlen == 1 else max(widths[name], stored)
+
+        columns = {}
+        for name, dimension in cls.encoded.items():
+            key_column = getattr(cls, dimension.key_column)
+            counts = {key: count for key, count in db.session.query(key_column, db.func.count()).group_by(key_column)
+                      if key is not None}
+            sizes = {}
+            for chunk in chunks(counts, 1000):
+                sizes.update(db.session.query(dimension.id, cls.stored_bytes(getattr(dimension, dimension.column)))
+                             .filter(dimension.id.in_(chunk)))
+            sizes = {key: size or 0 for key, size in sizes.items()}
+            columns[name] = dict(before=sum(char_bytes(name, sizes.get(key, 0)) * count for key, count in counts.items()),
+                                 after=8 * sum(counts.values()) + 8 * len(sizes) + sum(sizes.values()),
+                                 distinct=len(sizes))
+
+        for name in ("source_ip", "created_by"):
+            length = cls.stored_bytes(getattr(cls, name))
+            lengths = [(size, count) for size, count in db.session.query(length, db.func.count()).group_by(length)
+                       if size is not None]
+            #: MySQL VARCHAR length prefix, 2 bytes once the column may hold more than 255,
+            #: SQLite stores CHAR and VARCHAR alike
+            prefix = (2 if widths[name] * maxlen > 255 else 1) if mysql else 0
+            columns[name] = dict(before=sum(char_bytes(name, size) * count for size, count in lengths),
+                                 after=sum((size + prefix) * count for size, count in lengths))
+
+        before = sum(column["before"] for column in columns.values())
+        after = sum(column["after"] for column in columns.values())
+        report = dict(rows=rows, columns=columns, before=before, after=after, saved=before - after)
+
+        if mysql:
+            tables = [cls.__tablename__] + [dimension.__tablename__ for dimension in cls.encoded.values()]
+            report["tables"] = dict(db.session.execute(text(
+                "SELECT table_name, data_length + index_length FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name IN :tables"
+            ).bindparams(bindparam("tables", expanding=True)), {"tables": tables}))
+
+        return report
+
+    @classmethod
+    def recent_ids(cls, since):
+        """
+        :param datetime since: request_time lower bound, naive local time like the stored rows
+        """
+        return [_id for _id, in cls.query.with_entities(cls.id).filter(cls.request_time >= since)]
+
+    @classmethod
+    def existing_ids(cls, ids):
+        """
+        :param ids: event ids to look up
+        :return set: the ids already stored
+        """
+        existing = set()
+        for chunk in chunks(ids, 1000):
+            existing.update(_id for _id, in cls.query.with_entities(cls.id).filter(cls.id.in_(chunk)))
+
+        return existing
+
+    @classmethod
+    def fill_defaults(cls, data):
+        """
+        Multi-row INSERT needs the same columns on every row, so apply the
+        column defaults here instead of leaving them to the ORM.
+        """
+        row = {}
+        for column in cls.__table__.columns:
+            if column.name in data:
+                row[column.name] = data[column.name]
+            elif column.default is None:
+                row[column.name] = None
+            elif column.default.is_callable:
+                row[column.name] = column.default.arg(None)
+            else:
+                row[column.name] = column.default.arg
+
+        return row
+
+    @classmethod
+    def upsert_statement(cls, rows):
+        table = cls.__table__
+        if db.engine.dialect.name != "mysql":
+            return table.insert().prefix_with("OR REPLACE").values(rows)
+
+        stmt = mysql_insert(table).values(rows)
+        return stmt.on_duplicate_key_update(**{
+            column.name: stmt.inserted[column.name]
+            for column in table.columns if not column.primary_key
+        })
+
+    @classmethod
+    def bulk_upsert(cls, events, chunk_size=500, before_commit=None):
+        """
+        Write events with multi-row INSERT ... ON DUPLICATE KEY UPDATE,
+        one transaction per chunk.
+        :param events: iterable of dict, see Aliyun.conv_event
+        :param int chunk_size: rows per statement
+        :param before_commit: called with the events of each chunk inside its transaction,
+            e.g. to bump the rollups together with the rows they count
+        :return int: number of rows written
+        """
+        total = 0
+        for chunk in chunks(events, chunk_size):
+            rows = [cls.fill_defaults(event) for event in cls.encode(chunk)]
+            try:
+                db.session.execute(cls.upsert_statement(rows))
+                if before_commit is not None:
+                    before_commit(chunk)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            total += len(rows)
+
+        return total
 
     @classmethod
     def add(cls, data):
-        event = cls(**data)
+        event = cls(**cls.encode([data])[0])
         event.save()
 
         return event
@@ -67,3 +467,343 @@ class AliEvent(db.Model):
         db.session.add(self)
         db.session.commit()
         return self
+
+
+#: the event rows as they were before dictionary encoding, for SQL consumers of ali_event,
+#: the migration creates the same view
+VIEW_SELECT = """
+SELECT e.id, e.name, e.source, e.request_time, e.type, e.version, e.err_code, e.err_msg, e.request_id,
+       e.request_param, s.service_name, e.source_ip, u.user_agent, i.identity, e.created_by
+FROM ali_event e
+LEFT JOIN ali_service s ON s.id = e.service_key
+LEFT JOIN ali_user_agent u ON u.id = e.user_agent_key
+LEFT JOIN ali_identity i ON i.id = e.identity_key
+"""
+#: after every table, create_all may run again on an existing database
+sa_event.listen(db.Model.metadata, "after_create", DDL(
+    f"CREATE OR REPLACE VIEW ali_event_view AS {VIEW_SELECT}").execute_if(dialect="mysql"))
+sa_event.listen(db.Model.metadata, "after_create", DDL(
+    f"CREATE VIEW IF NOT EXISTS ali_event_view AS {VIEW_SELECT}").execute_if(dialect="sqlite"))
+sa_event.listen(db.Model.metadata, "before_drop", DDL("DROP VIEW IF EXISTS ali_event_view"))
+#: same partitioning as migration 8e4f1b6c2d90 for tables built by create_all,
+#: the months are added by ecs.partition
+sa_event.listen(AliEvent.__table__, "after_create", DDL(
+    "ALTER TABLE ali_event PARTITION BY RANGE (TO_DAYS(request_time)) "
+    "(PARTITION pmax VALUES LESS THAN MAXVALUE)").execute_if(dialect="mysql"))
+
+
+class AliEventRollup(db.Model):
+    """
+    Event counts per bucket, service, API name, user and error/success.
+    Ingestion bumps the minute buckets, `compact` folds them into hours and days.
+    """
+    __tablename__ = "ali_event_rollup"
+
+    minute = "minute"
+    hour = "hour"
+    day = "day"
+    #: granularity -> truncate a datetime to its bucket
+    truncate = {
+        minute: lambda t: t.replace(second=0, microsecond=0),
+        hour: lambda t: t.replace(minute=0, second=0, microsecond=0),
+        day: lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0),
+    }
+    dimensions = ("service_name", "name", "created_by", "failed")
+
+    granularity = db.Column(db.String(8), primary_key=True)
+    #: 桶的开始时间，和 ali_event.request_time 一样是本地时间
+    bucket = db.Column(db.DateTime, primary_key=True)
+    service_name = db.Column(db.String(64), primary_key=True, default="")
+    name = db.Column(db.String(64), primary_key=True, default="")
+    created_by = db.Column(db.String(128), primary_key=True, default="")
+    failed = db.Column(db.Boolean, primary_key=True, default=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def counts(cls, events):
+        """
+        :param events: converted events, see Aliyun.conv_event
+        :return Counter: (bucket, service_name, name, created_by, failed) -> count
+        """
+        return Counter(
+            (cls.truncate[cls.minute](event["request_time"].replace(tzinfo=None)),
+             event.get("service_name") or "", event.get("name") or "",
+             event.get("created_by") or "unknow", bool(event.get("err_code")))
+            for event in events
+        )
+
+    @classmethod
+    def bump(cls, counts, granularity=minute, commit=True):
+        """
+        Add counts to the buckets, creating them when missing.
+        :param Counter counts: see `counts`
+        """
+        table = cls.__table__
+        rows = [
+            dict(zip(("bucket",) + cls.dimensions, key), granularity=granularity, count=count)
+            for key, count in counts.items()
+        ]
+
+        for chunk in chunks(rows, 500):
+            if db.engine.dialect.name == "mysql":
+                stmt = mysql_insert(table).values(chunk)
+                db.session.execute(stmt.on_duplicate_key_update(count=table.c.count + stmt.inserted["count"]))
+            else:
+                db.session.execute(table.insert().prefix_with("OR IGNORE"), [dict(row, count=0) for row in chunk])
+                db.session.execute(
+                    table.update().values(count=table.c.count + bindparam("_count")).where(and_(
+                        table.c.granularity == bindparam("_granularity"), table.c.bucket == bindparam("_bucket"),
+                        *[table.c[name] == bindparam(f"_{name}") for name in cls.dimensions]
+                    )),
+                    [{f"_{name}": value for name, value in row.items()} for row in chunk]
+                )
+
+        if commit:
+            db.session.commit()
+
+    @classmethod
+    def compact(cls, source, target, before):
+        """
+        Fold `source` buckets older than `before` into `target` buckets, in one transaction.
+        Exactly the counts read are taken off the source rows, a `bump` landing in between
+        (late events, backfill) stays there for the next compact instead of being deleted.
+        :param datetime before: aligned to the target granularity, so folded buckets are complete
+        :return int: number of source rows folded
+        """
+        table = cls.__table__
+        keys = ("granularity", "bucket") + cls.dimensions
+        rows = db.session.execute(
+            table.select().where(and_(table.c.granularity == source, table.c.bucket < before))
+        ).fetchall()
+        counts = Counter()
+        for row in rows:
+            counts[(cls.truncate[target](row.bucket),) + tuple(row[name] for name in cls.dimensions)] += row.count
+
+        try:
+            cls.bump(counts, target, commit=False)
+            folded = [dict({f"_{name}": row[name] for name in keys}, _count=row.count) for row in rows]
+            for chunk in chunks(folded, 500):
+                db.session.execute(
+                    table.update().values(count=table.c.count - bindparam("_count")).where(
+                        and_(*[table.c[name] == bindparam(f"_{name}") for name in keys])
+                    ),
+                    chunk
+                )
+            db.session.execute(table.delete().where(and_(
+                table.c.granularity == source, table.c.bucket < before, table.c.count <= 0
+            )))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return len(rows)
+
+    @classmethod
+    def totals(cls, start_time=None, end_time=None, group_by=("service_name",), **filters):
+        """
+        Sum over every granularity, a folded bucket is counted once, by its start time.
+        :param tuple group_by: dimensions to group on
+        :param filters: equality filters on the dimensions
+        :return list: dicts of the group_by dimensions and count
+        """
+        columns = [getattr(cls, name) for name in group_by]
+        query = db.session.query(*columns, db.func.sum(cls.count))
+        for name, value in filters.items():
+            if name not in cls.dimensions:
+                raise ValueError(f"invalid filter: {name}")
+            query = query.filter(getattr(cls, name) == value)
+        if start_time:
+            query = query.filter(cls.bucket >= start_time)
+        if end_time:
+            query = query.filter(cls.bucket < end_time)
+
+        return [
+            dict(zip(group_by, row[:-1]), count=int(row[-1]))
+            for row in query.group_by(*columns)
+        ]
+
+
+class SyncCheckpoint(db.Model):
+    """
+    High-water mark of the incremental ActionTrail sync, one row per account and region.
+    """
+    __tablename__ = "ali_sync_checkpoint"
+
+    account = db.Column(db.String(64), primary_key=True)
+    region_id = db.Column(db.String(64), primary_key=True)
+    #: 最后一次入库事件的 request_time - UTC
+    request_time = db.Column(db.DateTime)
+    #: request_time 时刻已入库的事件ID
+    event_ids = db.Column(JSONType, default=[])
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    #: 最后一次同步开始时间 - UTC
+    last_run_at = db.Column(db.DateTime)
+    #: 最后一次同步耗时(秒)
+    last_duration = db.Column(db.Float)
+    #: 最后一次同步状态: finished/failed/deferred
+    last_status = db.Column(db.String(16))
+    #: 最后一次同步入库事件数
+    last_events = db.Column(db.Integer)
+    last_error = db.Column(db.Text)
+
+    finished = "finished"
+    failed = "failed"
+    #: no free shard slot, the next cron run picks it up
+    deferred = "deferred"
+
+    @classmethod
+    def load(cls, account, region_id):
+        checkpoint = cls.query.get((account, region_id))
+        if checkpoint is None:
+            checkpoint = cls(account=account, region_id=region_id, event_ids=[])
+
+        return checkpoint
+
+    def seen(self, request_time, event_id):
+        """
+        :param datetime request_time: naive UTC
+        :param str event_id: event id
+        :return bool: the event sits on the mark and was already ingested
+        """
+        return request_time == self.request_time and event_id in (self.event_ids or [])
+
+    def advance(self, marks):
+        """
+        :param marks: iterable of (request_time, event_id), request_time is naive UTC
+        """
+        self.move(marks)
+        return self.save()
+
+    def move(self, marks):
+        """
+        `advance` without saving, for a checkpoint kept outside the database, see Aliyun.sync_events.
+        """
+        request_time, event_ids = self.request_time, list(self.event_ids or [])
+        for _time, _id in marks:
+            if request_time is None or _time > request_time:
+                request_time, event_ids = _time, [_id]
+            elif _time == request_time and _id not in event_ids:
+                event_ids.append(_id)
+
+        self.request_time = request_time
+        #: assign a new list, JSONType does not track in-place changes
+        self.event_ids = event_ids
+        return self
+
+    def record(self, status, started_at, duration=0.0, events=0, error=None):
+        """
+        Keep the outcome of a sync run for the health report.
+        :param str status: finished/failed/deferred
+        :param datetime started_at: naive UTC
+        """
+        self.last_run_at = started_at
+        self.last_duration = round(duration, 3)
+        self.last_status = status
+        self.last_events = events
+        self.last_error = error
+        return self.save()
+
+    def lag(self, now=None):
+        """
+        :return float: seconds the newest stored event is behind `now` (UTC), None before the first event
+        """
+        if self.request_time is None:
+            return None
+        return ((now or datetime.datetime.utcnow()) - self.request_time).total_seconds()
+
+    def to_dict(self, now=None):
+        return {
+            "account": self.account,
+            "region_id": self.region_id,
+            "request_time": self.request_time,
+            "lag": self.lag(now),
+            "last_run_at": self.last_run_at,
+            "last_duration": self.last_duration,
+            "last_status": self.last_status,
+            "last_events": self.last_events,
+            "last_error": self.last_error,
+        }
+
+    @classmethod
+    def report(cls, shards=(), now=None):
+        """
+        Health of every shard, slowest first.
+        :param shards: configured (account, region_id), listed even before their first run
+        :return list: dict per shard, `configured` is False for checkpoints of removed shards
+        """
+        now = now or datetime.datetime.utcnow()
+        shards = set(shards)
+        rows = {(checkpoint.account, checkpoint.region_id): checkpoint for checkpoint in cls.query}
+        for account, region_id in shards - rows.keys():
+            rows[(account, region_id)] = cls(account=account, region_id=region_id, event_ids=[])
+
+        report = [dict(checkpoint.to_dict(now), configured=key in shards) for key, checkpoint in rows.items()]
+        #: never synced first, then by lag
+        return sorted(report, key=lambda row: (row["lag"] is not None, -(row["lag"] or 0)))
+
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
+        return self
+
+
+class BackfillWindow(db.Model):
+    """
+    Progress of a backfill, one row per time window, so an interrupted run resumes.
+    """
+    __tablename__ = "ali_backfill_window"
+
+    pending = "pending"
+    failed = "failed"
+    finished = "finished"
+
+    account = db.Column(db.String(64), primary_key=True)
+    region_id = db.Column(db.String(64), primary_key=True)
+    #: 窗口起止时间 - UTC
+    start_time = db.Column(db.DateTime, primary_key=True)
+    end_time = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(16), nullable=False, default=pending)
+    events = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    @classmethod
+    def plan(cls, account, region_id, start_time, end_time, size):
+        """
+        :param datetime start_time: naive UTC
+        :param datetime end_time: naive UTC
+        :param timedelta size: window size
+        :return list: windows covering [start_time, end_time), the stored ones keep their status
+            unless their end moved, e.g. the partial last window of a run that ended earlier
+        """
+        stored = {
+            window.start_time: window
+            for window in cls.query.filter(
+                cls.account == account, cls.region_id == region_id,
+                cls.start_time >= start_time, cls.start_time < end_time
+            )
+        }
+
+        windows = []
+        while start_time < end_time:
+            window = stored.get(start_time)
+            window_end = min(start_time + size, end_time)
+            if window is None:
+                window = cls(account=account, region_id=region_id, start_time=start_time,
+                             end_time=window_end, status=cls.pending, events=0)
+                db.session.add(window)
+            elif window.end_time != window_end:
+                #: fetched again whole, the upsert skips the events stored the first time
+                window.end_time, window.status, window.events = window_end, cls.pending, 0
+            windows.append(window)
+            start_time += size
+
+        db.session.commit()
+        return windows
+
+    def mark(self, status, events=0):
+        self.status = status
+        self.events = events
+        db.session.add(self)
+        db.session.commit()
+        return self
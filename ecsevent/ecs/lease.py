@@ -0,0 +1,197 @@
+# -*- coding:utf-8 -*-
+import threading
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from redis.exceptions import WatchError
+
+__all__ = ["Lease", "LeaseLost", "Semaphore", "single_flight"]
+
+
+class LeaseLost(Exception):
+    """ raised by a holder that finds its lease taken over, before it writes anything that assumes it """
+
+    def __init__(self, message=None):
+        super().__init__(message or "Lease lost")
+
+
+@contextmanager
+def _heartbeat(renew, interval, lost):
+    """
+    Call `renew` every `interval` seconds while the block runs, set `lost` and stop once it fails.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            if not renew():
+                lost.set()
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+class Lease(object):
+    """
+    Redis lease held by one owner at a time, expires after `ttl` seconds unless
+    renewed. Compare-and-set runs in WATCH/MULTI, no Lua, so fakeredis works.
+    """
+    skip = "skip"
+    coalesce = "coalesce"
+
+    def __init__(self, connection, name, ttl=60):
+        """
+        :param connection: redis connection
+        :param str name: lease name, e.g. "sync_aliyun_events:<account>:<region>"
+        :param int ttl: seconds
+        """
+        self.connection = connection
+        self.key = f"ecs:lease:{name}"
+        self.pending_key = f"{self.key}:pending"
+        self.ttl = ttl
+        self.token = uuid4().hex.encode()
+        self.lost = threading.Event()
+
+    def acquire(self):
+        return bool(self.connection.set(self.key, self.token, px=int(self.ttl * 1000), nx=True))
+
+    def _if_owner(self, command):
+        with self.connection.pipeline() as pipeline:
+            try:
+                pipeline.watch(self.key)
+                if pipeline.get(self.key) != self.token:
+                    return False
+                pipeline.multi()
+                command(pipeline)
+                pipeline.execute()
+                return True
+            except WatchError:
+                return False
+
+    def renew(self):
+        return self._if_owner(lambda pipeline: pipeline.pexpire(self.key, int(self.ttl * 1000)))
+
+    def release(self):
+        return self._if_owner(lambda pipeline: pipeline.delete(self.key))
+
+    @contextmanager
+    def heartbeat(self, interval=None):
+        """
+        Renew the lease every `interval` seconds (ttl / 3) while the block runs,
+        `lost` is set when a renewal finds the lease taken over.
+        """
+        with _heartbeat(self.renew, interval or self.ttl / 3, self.lost):
+            yield self
+
+
+class Semaphore(object):
+    """
+    Redis counting semaphore, at most `limit` holders of `name` across all workers.
+    Holders sit in a sorted set scored by their last renewal, a holder not renewed
+    within `ttl` seconds (a killed worker) is dropped by the next acquire.
+    """
+
+    def __init__(self, connection, name, limit, ttl=60):
+        """
+        :param connection: redis connection
+        :param str name: semaphore name, e.g. "sync_aliyun_events"
+        :param int limit: concurrent holders
+        :param int ttl: seconds
+        """
+        self.connection = connection
+        self.key = f"ecs:semaphore:{name}"
+        self.limit = limit
+        self.ttl = ttl
+        self.token = uuid4().hex.encode()
+        self.lost = threading.Event()
+
+    def _acquire(self):
+        now = time.time()
+        with self.connection.pipeline() as pipeline:
+            pipeline.zremrangebyscore(self.key, "-inf", now - self.ttl)
+            #: StrictRedis signature, same as `ecs.tasks.Scheduler._zadd`
+            pipeline.zadd(self.key, now, self.token)
+            pipeline.zrank(self.key, self.token)
+            rank = pipeline.execute()[-1]
+
+        if rank is not None and rank < self.limit:
+            return True
+        self.connection.zrem(self.key, self.token)
+        return False
+
+    def acquire(self, wait=0, poll=1):
+        """
+        :param float wait: seconds to wait for a free slot
+        :param float poll: seconds between attempts
+        :return bool: a slot was taken
+        """
+        deadline = time.monotonic() + wait
+        while not self._acquire():
+            if time.monotonic() + poll > deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def renew(self):
+        """
+        :return bool: the slot is still held
+        """
+        with self.connection.pipeline() as pipeline:
+            pipeline.zscore(self.key, self.token)
+            pipeline.zadd(self.key, time.time(), self.token)
+            held, _ = pipeline.execute()
+        if held is None:
+            #: expired meanwhile, do not take a slot back behind the others' back
+            self.connection.zrem(self.key, self.token)
+            return False
+        return True
+
+    def release(self):
+        return bool(self.connection.zrem(self.key, self.token))
+
+    def holders(self):
+        """
+        :return int: live holders
+        """
+        return self.connection.zcount(self.key, time.time() - self.ttl, "+inf")
+
+    @contextmanager
+    def heartbeat(self, interval=None):
+        """
+        Renew the slot every `interval` seconds (ttl / 3) while the block runs.
+        """
+        with _heartbeat(self.renew, interval or self.ttl / 3, self.lost):
+            yield self
+
+
+def single_flight(connection, name, func, policy=Lease.skip, ttl=60):
+    """
+    Run `func` unless another run of `name` holds the lease.
+    skip: a concurrent call is dropped.
+    coalesce: a concurrent call marks the lease pending, the holder runs once more before releasing.
+    :param func: called with the lease, a long run checks `lease.lost` before its writes
+    :return tuple: (ran, result of the last run)
+    """
+    lease = Lease(connection, name, ttl)
+    if not lease.acquire():
+        if policy == Lease.coalesce:
+            connection.set(lease.pending_key, 1, ex=ttl)
+        return False, None
+
+    try:
+        with lease.heartbeat():
+            connection.delete(lease.pending_key)
+            result = func(lease)
+            while policy == Lease.coalesce and connection.delete(lease.pending_key) and not lease.lost.is_set():
+                result = func(lease)
+    finally:
+        lease.release()
+
+    return True, result
@@ -0,0 +1,190 @@
+# -*- coding:utf-8 -*-
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from redis.exceptions import RedisError
+
+__all__ = ["Counter", "Histogram", "Gauge", "flush", "render", "CONTENT_TYPE"]
+
+#: one hash holds every counter and histogram sample of every process
+KEY = "ecs:metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PAGES = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+EVENTS = (0, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+REGISTRY = {}
+
+#: samples added since the last flush, field -> amount
+_buffer = {}
+_buffer_lock = threading.Lock()
+
+_le = re.compile(r'[{,]le="([^"]+)"}$')
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _field(name, labels, le=None):
+    pairs = [f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())]
+    if le is not None:
+        #: always last, `render` sorts the buckets on it
+        pairs.append(f'le="{le}"')
+    return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+
+def _add(field, amount):
+    with _buffer_lock:
+        _buffer[field] = _buffer.get(field, 0) + amount
+
+
+def _format(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        REGISTRY[name] = self
+
+    def check(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.labels)}")
+        return labels
+
+    def owns(self, sample):
+        return sample == self.name
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount:
+            _add(_field(self.name, self.check(labels)), amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=SECONDS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self.check(labels)
+        for bound in self.buckets:
+            if value <= bound:
+                _add(_field(f"{self.name}_bucket", labels, _format(bound)), 1)
+        _add(_field(f"{self.name}_bucket", labels, "+Inf"), 1)
+        _add(_field(f"{self.name}_sum", labels), value)
+        _add(_field(f"{self.name}_count", labels), 1)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def owns(self, sample):
+        return sample in (f"{self.name}_bucket", f"{self.name}_sum", f"{self.name}_count")
+
+
+class Gauge(Metric):
+    """
+    Per process, not flushed to Redis, set right before `render` by whoever serves the scrape.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super(Gauge, self).__init__(name, documentation, labels)
+        self.values = {}
+
+    def set(self, value, **labels):
+        self.values[_field(self.name, self.check(labels))] = value
+
+    def clear(self):
+        self.values = {}
+
+
+def flush(connection):
+    """
+    Add the samples buffered by this process to the shared totals,
+    they stay buffered for the next flush when Redis is unavailable.
+    :return int: fields written
+    """
+    global _buffer
+    with _buffer_lock:
+        buffered, _buffer = _buffer, {}
+    if not buffered:
+        return 0
+
+    try:
+        with connection.pipeline(transaction=False) as pipeline:
+            for field, amount in buffered.items():
+                pipeline.hincrbyfloat(KEY, field, amount)
+            pipeline.execute()
+    except RedisError:
+        for field, amount in buffered.items():
+            _add(field, amount)
+        return 0
+
+    return len(buffered)
+
+
+def _sort_key(field):
+    """ histogram buckets of the same series in ascending `le` order """
+    match = _le.search(field)
+    if match is None:
+        return field, 0.0
+    return field[:match.start()], float(match.group(1))
+
+
+def render(connection):
+    """
+    :return str: every registered metric in the Prometheus text format
+    """
+    samples = {}
+    for field, value in connection.hgetall(KEY).items():
+        field = field.decode() if isinstance(field, bytes) else field
+        samples[field] = float(value)
+
+    lines = []
+    for name, metric in sorted(REGISTRY.items()):
+        values = metric.values if isinstance(metric, Gauge) else {
+            field: value for field, value in samples.items() if metric.owns(field.split("{", 1)[0])
+        }
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for field in sorted(values, key=_sort_key):
+            lines.append(f"{field} {_format(values[field])}")
+
+    return "\n".join(lines) + "\n"
+
+
+api_request_seconds = Histogram(
+    "ecs_api_request_seconds", "ActionTrail LookupEvents latency per attempt",
+    labels=("account", "region_id", "outcome"))
+sync_run_pages = Histogram(
+    "ecs_sync_run_pages", "pages fetched per sync run", labels=("account", "region_id"), buckets=PAGES)
+sync_run_events = Histogram(
+    "ecs_sync_run_events", "new events stored per sync run", labels=("account", "region_id"), buckets=EVENTS)
+convert_seconds = Histogram("ecs_convert_seconds", "conv_event time per page")
+db_write_seconds = Histogram("ecs_db_write_seconds", "database write latency per batch", labels=("table",))
+dedup_skipped = Counter("ecs_dedup_skipped_total", "events dropped before the write, already stored or unstorable",
+                        labels=("reason",))
+sync_lag_seconds = Gauge(
+    "ecs_sync_lag_seconds", "now minus the newest stored request_time", labels=("account", "region_id"))
+spool_appended = Counter("ecs_spool_appended_total", "events written to the local spool")
+spool_drained = Counter("ecs_spool_drained_total", "spooled events handed to the database")
+spool_corrupt = Counter("ecs_spool_corrupt_records_total", "unreadable spool records skipped")
@@ -0,0 +1,156 @@
+# -*- coding:utf-8 -*-
+import datetime
+import logging
+
+from sqlalchemy import text
+
+__all__ = ["PartitionManager", "MysqlPartitions", "EmulatedPartitions"]
+
+log = logging.getLogger(__name__)
+
+
+def month_start(day):
+    return datetime.date(day.year, day.month, 1)
+
+
+def next_month(day):
+    return datetime.date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def partition_name(day):
+    return f"p{day:%Y%m}"
+
+
+class MysqlPartitions(object):
+    """
+    RANGE (TO_DAYS(request_time)) partitions, `pmax` catches rows past the last bound.
+    """
+
+    def __init__(self, connection, table):
+        self.connection = connection
+        self.table = table
+
+    def partitioned(self):
+        """
+        :return bool: the table is partitioned, False e.g. for a table created before the
+            model declared its partitioning, see migration 8e4f1b6c2d90
+        """
+        return bool(self.connection.execute(text(
+            "SELECT COUNT(*) FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL"
+        ), table=self.table).scalar())
+
+    def list(self):
+        """
+        :return dict: partition name -> upper bound (date), pmax excluded
+        """
+        rows = self.connection.execute(text(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL"
+        ), table=self.table)
+
+        return {
+            name: datetime.date.fromordinal(int(bound) - 365)
+            for name, bound in rows if bound != "MAXVALUE"
+        }
+
+    def create(self, name, upper):
+        self.connection.execute(text(
+            f"ALTER TABLE {self.table} REORGANIZE PARTITION pmax INTO ("
+            f"PARTITION {name} VALUES LESS THAN (TO_DAYS('{upper:%Y-%m-%d}')), "
+            f"PARTITION pmax VALUES LESS THAN MAXVALUE)"
+        ))
+
+    def drop(self, name, upper):
+        self.connection.execute(text(f"ALTER TABLE {self.table} DROP PARTITION {name}"))
+
+
+class EmulatedPartitions(object):
+    """
+    Same bookkeeping for engines without partitioning (SQLite in tests),
+    a drop is a range DELETE here, so it is not O(1).
+    """
+
+    def __init__(self, connection, table):
+        self.connection = connection
+        self.table = table
+        self.registry = f"{table}_partition"
+        self.connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {self.registry} (name VARCHAR(16) PRIMARY KEY, upper DATE NOT NULL)"
+        ))
+
+    def partitioned(self):
+        return True
+
+    def list(self):
+        rows = self.connection.execute(text(f"SELECT name, upper FROM {self.registry}"))
+        return {
+            name: upper if isinstance(upper, datetime.date) else datetime.datetime.strptime(upper, "%Y-%m-%d").date()
+            for name, upper in rows
+        }
+
+    def create(self, name, upper):
+        self.connection.execute(text(f"INSERT INTO {self.registry} (name, upper) VALUES (:name, :upper)"),
+                                name=name, upper=upper)
+
+    def drop(self, name, upper):
+        self.connection.execute(text(f"DELETE FROM {self.table} WHERE request_time < :upper"), upper=upper)
+        self.connection.execute(text(f"DELETE FROM {self.registry} WHERE name = :name"), name=name)
+
+
+class PartitionManager(object):
+    """
+    Monthly partitions of ali_event on request_time: keep `ahead` future months
+    created and drop the months older than `retention_days`.
+    """
+
+    def __init__(self, engine, table="ali_event", retention_days=365, ahead=3):
+        self.engine = engine
+        self.table = table
+        self.retention_days = retention_days
+        self.ahead = ahead
+
+    def backend(self, connection):
+        if self.engine.dialect.name == "mysql":
+            return MysqlPartitions(connection, self.table)
+        return EmulatedPartitions(connection, self.table)
+
+    def plan(self, partitions, today):
+        """
+        :param dict partitions: existing partition name -> upper bound
+        :param date today: current day
+        :return tuple: ([(name, upper)] to create, [(name, upper)] to drop)
+        """
+        #: RANGE partitions only grow at the top, pmax is split
+        last = max(partitions.values(), default=datetime.date.min)
+        create = []
+        day = month_start(today)
+        for _ in range(self.ahead + 1):
+            if next_month(day) > last:
+                create.append((partition_name(day), next_month(day)))
+            day = next_month(day)
+
+        cutoff = today - datetime.timedelta(days=self.retention_days)
+        drop = sorted((name, upper) for name, upper in partitions.items() if upper <= cutoff)
+
+        return create, drop
+
+    def maintain(self, today=None):
+        """
+        :param date today: defaults to today
+        :return dict: created and dropped partition names
+        """
+        today = today or datetime.date.today()
+        with self.engine.begin() as connection:
+            backend = self.backend(connection)
+            if not backend.partitioned():
+                log.warning("%s is not partitioned, run the migrations to partition it", self.table)
+                return dict(created=[], dropped=[], skipped=f"{self.table} is not partitioned")
+            create, drop = self.plan(backend.list(), today)
+
+            for name, upper in create:
+                backend.create(name, upper)
+            for name, upper in drop:
+                backend.drop(name, upper)
+
+        return dict(created=[name for name, _ in create], dropped=[name for name, _ in drop])
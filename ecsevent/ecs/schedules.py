@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+from collections import namedtuple
+
+from ecs.tasks import rq, run
+
+__all__ = ["PeriodicJob", "SCHEDULES", "sync_schedules", "list_schedules"]
+
+PeriodicJob = namedtuple("PeriodicJob", ["id", "cron", "mn", "fn", "description"])
+
+#: every periodic job, keyed by a stable id, `sync_schedules` makes Redis match this list
+SCHEDULES = [
+    PeriodicJob("cron-sync_aliyun_events", "* * * * *", "cron", "sync_aliyun_events", "aliyun sync_events"),
+    PeriodicJob("cron-maintain_event_partitions", "0 3 * * *", "cron", "maintain_event_partitions",
+                "ali_event partitions"),
+    PeriodicJob("cron-compact_event_rollups", "5 * * * *", "cron", "compact_event_rollups", "ali_event rollups"),
+    PeriodicJob("cron-drain_event_spool", "* * * * *", "cron", "drain_event_spool", "ali_event spool drain"),
+]
+
+#: job.meta flag of the jobs created here
+MANAGED = "managed"
+
+
+def _task(job):
+    """
+    :return tuple: (mn, fn) of a `ecs.tasks.run` job, None for other jobs
+    """
+    if job.func_name != f"{run.__module__}.{run.__name__}":
+        return None
+
+    kwargs = job.kwargs or {}
+    args = list(job.args or [])
+    return kwargs.get("mn", args[0] if args else None), kwargs.get("fn", args[1] if len(args) > 1 else None)
+
+
+def _matches(job, spec):
+    return (
+        job.meta.get("cron_string") == spec.cron
+        and _task(job) == (spec.mn, spec.fn)
+        and job.description == spec.description
+    )
+
+
+def sync_schedules(scheduler=None, schedules=None):
+    """
+    Add, update or remove scheduled jobs so exactly one job exists per declared schedule.
+    Jobs running the same task under another id (the random ids of earlier boots) are removed.
+    :return dict: job ids per action
+    """
+    scheduler = scheduler or rq.get_scheduler()
+    declared = {spec.id: spec for spec in (SCHEDULES if schedules is None else schedules)}
+    tasks = {(spec.mn, spec.fn) for spec in declared.values()}
+    result = dict(added=[], updated=[], removed=[], unchanged=[])
+
+    present, kept = set(), []
+    for job in scheduler.get_jobs():
+        spec = declared.get(job.id)
+        if spec is not None and _matches(job, spec):
+            present.add(job.id)
+            kept.append(job)
+            result["unchanged"].append(job.id)
+            continue
+
+        if spec is None and not (job.meta.get(MANAGED) or _task(job) in tasks):
+            kept.append(job)
+            continue
+
+        scheduler.cancel(job)
+        job.delete()
+        result["updated" if spec is not None else "removed"].append(job.id)
+
+    for spec in declared.values():
+        if spec.id in present:
+            continue
+
+        job = scheduler.cron(spec.cron, run, kwargs=dict(mn=spec.mn, fn=spec.fn), id=spec.id,
+                             description=spec.description, queue_name=rq.default_queue)
+        job.meta[MANAGED] = True
+        job.save()
+        if spec.id not in result["updated"]:
+            result["added"].append(spec.id)
+
+    #: jobs scheduled before the id and description indexes existed
+    scheduler.reindex(kept)
+    return result
+
+
+def list_schedules(scheduler=None):
+    """
+    :return list: dicts of the scheduled jobs, next run time first
+    """
+    scheduler = scheduler or rq.get_scheduler()
+    return [
+        dict(id=job.id, cron=job.meta.get("cron_string"), interval=job.meta.get("interval"),
+             next_run=scheduled_at, description=job.description, managed=bool(job.meta.get(MANAGED)))
+        for job, scheduled_at in scheduler.get_jobs(with_times=True)
+    ]
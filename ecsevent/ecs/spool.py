@@ -0,0 +1,264 @@
+# -*- coding:utf-8 -*-
+import fcntl
+import json
+import mmap
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+from ecs import metrics
+
+__all__ = ["Spool"]
+
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.strftime(TIME_FORMAT + ("%z" if obj.tzinfo else ""))
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def parse_time(value):
+    """
+    :param str value: written by `_default`, or by datetime.isoformat in older spools
+    :return datetime: aware when `value` has an offset, strptime only, Python 3.6 has no fromisoformat
+    """
+    #: %z takes +0800, not +08:00, before Python 3.7
+    if len(value) > 6 and value[-6] in "+-" and value[-3] == ":":
+        value = value[:-3] + value[-2:]
+    for fmt in (TIME_FORMAT, "%Y-%m-%dT%H:%M:%S"):
+        for zone in ("%z", ""):
+            try:
+                return datetime.strptime(value, fmt + zone)
+            except ValueError:
+                continue
+    raise ValueError(f"invalid time: {value}")
+
+
+def encode(data):
+    """
+    :param data: converted events (see Aliyun.conv_event), or a sync mark (see Spool.append_mark)
+    :return bytes: one record, JSON on a single line
+    """
+    return json.dumps(data, default=_default, separators=(",", ":")).encode() + b"\n"
+
+
+def decode(record):
+    """
+    :return tuple: (events, marks) of one record
+    """
+    data = json.loads(record)
+    if isinstance(data, dict):
+        mark = data["mark"]
+        mark["request_time"] = parse_time(mark["request_time"])
+        return [], [mark]
+
+    for event in data:
+        event["request_time"] = parse_time(event["request_time"])
+    return data, []
+
+
+class Spool(object):
+    """
+    Local append-only spool of converted events, a write-ahead log in front of ali_event.
+    Fetchers `append` pages to numbered segment files, `drain` replays them into the
+    database in large batches and keeps the offset it reached. A record is a line,
+    the last line is not read before its newline is written, a line torn by a crash
+    is terminated by the next append and skipped.
+
+    A sync appends a mark after its pages, the drain hands it over once the events
+    spooled before it are stored, so the database checkpoint never gets ahead of ali_event.
+
+    Writers of every process on the host serialize on `.append.lock`, drainers on `.drain.lock`.
+    """
+    suffix = ".seg"
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, batch_size=5000):
+        """
+        :param str directory: local directory, one spool per host
+        :param int segment_bytes: a new segment is started past this size
+        :param int batch_size: events per `drain` batch
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.batch_size = batch_size
+        self.offset_path = os.path.join(directory, "offset.json")
+        os.makedirs(directory, exist_ok=True)
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f"{number:012d}{self.suffix}")
+
+    def segments(self):
+        """
+        :return list: segment numbers, oldest first
+        """
+        return sorted(
+            int(name[:-len(self.suffix)]) for name in os.listdir(self.directory) if name.endswith(self.suffix)
+        )
+
+    @contextmanager
+    def _locked(self, name, blocking=True):
+        """
+        :return: True when the lock is held, False when `blocking` is off and someone else holds it
+        """
+        with open(os.path.join(self.directory, name), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, events):
+        """
+        Write a page of events, durable (fsync) on return.
+        :return int: bytes written
+        """
+        if not events:
+            return 0
+
+        written = self._write(encode(events))
+        metrics.spool_appended.inc(len(events))
+        return written
+
+    def append_mark(self, account, region_id, request_time, event_ids):
+        """
+        Write the sync checkpoint reached by the events appended before, see SyncCheckpoint.advance.
+        :param datetime request_time: naive UTC
+        :return int: bytes written
+        """
+        return self._write(encode(dict(mark=dict(
+            account=account, region_id=region_id, request_time=request_time, event_ids=list(event_ids)
+        ))))
+
+    def _write(self, record):
+        with self._locked(".append.lock"):
+            segments = self.segments()
+            number = segments[-1] if segments else 0
+            path = self.segment_path(number)
+            if os.path.exists(path) and os.path.getsize(path) >= self.segment_bytes:
+                path = self.segment_path(number + 1)
+
+            with open(path, "ab+") as f:
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        #: terminate a record torn by a crash, `drain` skips it
+                        record = b"\n" + record
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+
+        return len(record)
+
+    def load_offset(self):
+        """
+        :return tuple: (segment number, byte offset) drained so far
+        """
+        try:
+            with open(self.offset_path) as f:
+                offset = json.load(f)
+        except FileNotFoundError:
+            return 0, 0
+        return offset["segment"], offset["offset"]
+
+    def save_offset(self, segment, offset):
+        tmp = f"{self.offset_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(dict(segment=segment, offset=offset), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.offset_path)
+
+    def records(self, segment, offset):
+        """
+        Complete records of a segment from `offset` on, read through mmap.
+        :return: iterator of (record bytes, offset after the record)
+        """
+        with open(self.segment_path(segment), "rb") as f:
+            if os.fstat(f.fileno()).st_size <= offset:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                while True:
+                    end = data.find(b"\n", offset)
+                    if end < 0:
+                        return
+                    yield data[offset:end], end + 1
+                    offset = end + 1
+
+    def backlog(self):
+        """
+        :return int: bytes appended and not drained yet
+        """
+        drained_segment, drained_offset = self.load_offset()
+        total = 0
+        for number in self.segments():
+            if number > drained_segment:
+                total += os.path.getsize(self.segment_path(number))
+            elif number == drained_segment:
+                total += os.path.getsize(self.segment_path(number)) - drained_offset
+        return total
+
+    @staticmethod
+    def _hand_over(handler, on_marks, batch, marks):
+        if batch:
+            handler(batch)
+        if marks and on_marks is not None:
+            on_marks(marks)
+        return len(batch)
+
+    def drain(self, handler, batch_size=None, on_marks=None):
+        """
+        Hand the spooled events to `handler` in batches of about `batch_size` (self.batch_size),
+        the offset moves only after `handler` returns. Drained segments are removed,
+        except the newest one that writers still append to.
+        A drain already running on this host makes this one a no-op.
+        :param handler: called with a list of events, e.g. Aliyun.ingest
+        :param on_marks: called with the marks read along with a batch, once `handler` stored it
+        :return int: events handed over, None when another drain holds the lock
+        """
+        with self._locked(".drain.lock", blocking=False) as locked:
+            if not locked:
+                return None
+
+            batch_size = batch_size or self.batch_size
+            drained_segment, drained_offset = self.load_offset()
+            #: listed once, every segment but the last one is complete, writers only append to the newest
+            segments = [number for number in self.segments() if number >= drained_segment]
+            total = 0
+            for number in segments:
+                offset = drained_offset if number == drained_segment else 0
+                batch, marks = [], []
+                for record, offset_after in self.records(number, offset):
+                    try:
+                        events, found = decode(record)
+                        batch.extend(events)
+                        marks.extend(found)
+                    except (ValueError, KeyError):
+                        metrics.spool_corrupt.inc()
+                    if len(batch) >= batch_size:
+                        total += self._hand_over(handler, on_marks, batch, marks)
+                        batch, marks = [], []
+                        self.save_offset(number, offset_after)
+                    offset = offset_after
+
+                total += self._hand_over(handler, on_marks, batch, marks)
+
+                if number == segments[-1]:
+                    self.save_offset(number, offset)
+                else:
+                    self.save_offset(number + 1, 0)
+                    os.remove(self.segment_path(number))
+
+            #: left behind by a drain that stopped between the two steps above
+            for number in self.segments():
+                if number < (segments[-1] if segments else drained_segment):
+                    os.remove(self.segment_path(number))
+
+            metrics.spool_drained.inc(total)
+            return total
@@ -1,27 +1,47 @@
 # -*- coding:utf-8 -*-
 # Author:      LiuSha
+import cProfile
+import io
+import logging
+import marshal
 import os
+import pstats
+import threading
+import time
 import croniter
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
 import importlib.util as import_module
 
 from uuid import uuid1
 from datetime import datetime
 from dateutil.tz import tzlocal, gettz
 from rq import get_current_job, worker
+from rq.job import Job, unpickle
+from rq.utils import utcparse
 from rq_scheduler.utils import to_unix
 from rq_scheduler.scheduler import Scheduler as rScheduler
 
-from ecs import json
+from ecs import json, metrics
 
 from flask_rq2 import RQ
 from flask_rq2.job import FlaskJob
 
 
-__all__ = ["run", "get_results", "uuid", "task_list", "InvalidFnError", "InvalidConfigError", "BaseTask"]
+__all__ = ["run", "get_results", "get_results_many", "get_profile", "cancel", "cancel_by_description",
+           "cancel_by_prefix", "uuid", "task_list", "preload_modules", "InvalidFnError", "InvalidConfigError",
+           "BaseTask"]
 
 
 rq = RQ()
 
+log = logging.getLogger(__name__)
+
+#: module name -> (mtime, module), per worker process
+_modules = {}
+_modules_lock = threading.Lock()
+
 
 class InvalidFnError(Exception):
 
@@ -39,6 +59,16 @@ def uuid():
     return str(uuid1()).replace("-", "")
 
 
+def short_description(description):
+    """
+    :return: the job description without the "ecs.tasks." prefix of the functions queued by name
+    """
+    prefix = "ecs.tasks."
+    if isinstance(description, str) and description.startswith(prefix):
+        return description[len(prefix):]
+    return description
+
+
 def absolute_path():
     return os.path.join(os.path.dirname(os.path.abspath(__file__)))
 
@@ -52,42 +82,159 @@ def task_list():
     ]
 
 
-def get_module(fn):
-    # invalidate_caches()
-    spec = import_module.spec_from_file_location(fn, f"{absolute_path()}/{fn}.py")
+def load_module(fn, path):
+    spec = import_module.spec_from_file_location(fn, path)
     module = import_module.module_from_spec(spec)
     spec.loader.exec_module(module)
 
     return module
 
 
-def get_results(job_id, time=None):
+def get_module(fn):
+    """
+    :param str fn: task module name
+    :return: the cached module, reloaded only when its file changed
+    """
+    path = f"{absolute_path()}/{fn}.py"
+    mtime = os.stat(path).st_mtime
+
+    cached = _modules.get(fn)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with _modules_lock:
+        cached = _modules.get(fn)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        module = load_module(fn, path)
+        _modules[fn] = (mtime, module)
+
+    return module
+
+
+def preload_modules():
+    """
+    Load every task module once, call it in the worker before jobs are forked.
+    :return list: loaded module names
+    """
+    return [get_module(mn).__name__ for mn in task_list()]
+
+
+def get_results(job_id):
     """
     :param str job_id: job id
-    :param datetime time: when the task is not completed, time is None
-    :return dict: result
+    :return dict: result, see get_results_many
     """
-    job = rq.get_queue().fetch_job(job_id)
-    if job.created_at and job.ended_at:
-        time = f"{(job.ended_at - job.created_at).total_seconds():.2f}"
+    return get_results_many([job_id])[job_id]
 
-    description = job.description.lstrip("ecs.tasks.") if isinstance(job.description, str) else job.description
-    return dict(result=job.result, status=job.status, time=time, description=description)
+
+def get_results_many(job_ids):
+    """
+    Status and result of many jobs with one pipelined round trip.
+    :param list job_ids: job ids
+    :return dict: job id -> dict(result, status, time, description), None when the job does not exist,
+        time is None when the task is not completed
+    """
+    fields = ("status", "result", "created_at", "ended_at", "description")
+    with rq.connection.pipeline(transaction=False) as pipeline:
+        for job_id in job_ids:
+            pipeline.hmget(Job.key_for(job_id), *fields)
+        rows = pipeline.execute()
+
+    results = {}
+    for job_id, row in zip(job_ids, rows):
+        status, result, created_at, ended_at, description = row
+        if status is None and description is None:
+            results[job_id] = None
+            continue
+
+        time = None
+        if created_at and ended_at:
+            time = f"{(utcparse(ended_at.decode()) - utcparse(created_at.decode())).total_seconds():.2f}"
+
+        description = description.decode() if description is not None else None
+        results[job_id] = dict(
+            result=unpickle(result) if result is not None else None,
+            status=status.decode() if status is not None else None,
+            time=time,
+            description=short_description(description)
+        )
+
+    return results
+
+
+def profile_key(job_id):
+    return f"{Job.key_for(job_id).decode()}:profile"
+
+
+def get_profile(job_id):
+    """
+    :return bytes: pstats dump of a job queued with `_profile=True`, None when there is none,
+        write it to a file for `pstats.Stats` / snakeviz
+    """
+    return rq.connection.get(profile_key(job_id))
+
+
+def _record_run(job, seconds, profiler=None):
+    """
+    Queue wait and run time of the job in job.meta["timings"], the profile next to the result.
+    Runs in the `finally` of the task, failures are logged and never replace the task result.
+    """
+    timings = job.meta.setdefault("timings", {})
+    timings["run"] = round(seconds, 3)
+    if job.enqueued_at and job.started_at:
+        timings["queue_wait"] = round((job.started_at - job.enqueued_at).total_seconds(), 3)
+
+    if profiler is not None:
+        try:
+            stats = pstats.Stats(profiler)
+            #: result_ttl is None or -1 (kept forever) for scheduled jobs, the profile always expires
+            ttl = job.result_ttl if job.result_ttl and job.result_ttl > 0 else 86400
+            rq.connection.set(profile_key(job.id), marshal.dumps(stats.stats), ex=ttl)
+            #: the top of the profile is readable without fetching the dump
+            summary = io.StringIO()
+            stats.stream = summary
+            stats.sort_stats("cumulative").print_stats(20)
+            job.meta["profile"] = summary.getvalue()
+        except Exception:
+            log.exception("failed to save the profile of job %s", job.id)
+
+    try:
+        job.save_meta()
+    except Exception:
+        log.exception("failed to save the timings of job %s", job.id)
 
 
 @rq.job(result_ttl=86400)
-def run(mn, fn, *args, **kwargs):
+def run(mn, fn, *args, _profile=False, **kwargs):
     """
     :param mn: module name of task
     :param fn: function name of task
     :param args: function args of task
+    :param _profile: run the task under cProfile, see get_profile
     :param kwargs: function kwargs of task
     :return: None
     """
 
     module = get_module(mn)
     klass = getattr(module, mn.capitalize())
-    return klass.execute(fn, *args, **kwargs)
+    profiler = cProfile.Profile() if _profile else None
+    started = time.monotonic()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return klass.execute(fn, *args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    finally:
+        job = get_current_job()
+        if job is not None:
+            _record_run(job, time.monotonic() - started, profiler)
+        #: worker side samples join the shared totals served by /metrics
+        metrics.flush(rq.connection)
 
 
 class BaseTask(object):
@@ -102,6 +249,9 @@ class BaseTask(object):
 
         self.cron = cron
         self.task_log = None
+        #: phase name -> seconds, see phase
+        self.phases = Counter()
+        self._phases_lock = threading.Lock()
 
         if self.cron:
             return
@@ -112,8 +262,7 @@ class BaseTask(object):
             self.job = get_current_job()
 
     def get_job_data(self):
-        description = self.job.description.lstrip("ecs.tasks.") \
-            if isinstance(self.job.description, str) else self.job.description
+        description = short_description(self.job.description)
 
         return {
             "id": self.job.id,
@@ -129,6 +278,39 @@ class BaseTask(object):
 
         }
 
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a named step, e.g. fetch, convert, dedup, write.
+        Repeated steps add up, so do steps running on several threads.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._phases_lock:
+                self.phases[name] += elapsed
+
+    def save_timings(self):
+        """
+        Add the phases timed so far to job.meta["timings"]["phases"] of the running job,
+        cron tasks included, nothing happens outside a worker.
+        :return dict: phases of the job
+        """
+        with self._phases_lock:
+            timed, self.phases = self.phases, Counter()
+
+        job = get_current_job()
+        if job is None:
+            return dict(timed)
+
+        phases = job.meta.setdefault("timings", {}).setdefault("phases", {})
+        for name, seconds in timed.items():
+            phases[name] = round(phases.get(name, 0) + seconds, 3)
+        job.save_meta()
+        return phases
+
     def update_task_log(self, result=None, status=None):
         if status not in [self.finished, self.failed, self.suspend]:
             status = self.finished
@@ -138,7 +320,9 @@ class BaseTask(object):
 
         if not self.cron and self.task_log:
             self.task_log.ended_at = datetime.utcnow()
-            self.task_log.time = f"{(self.task_log.ended_at - self.job.created_at).total_seconds():.2f}"
+            #: run time only, the queue wait is in job.meta["timings"]
+            started_at = self.job.started_at or self.job.created_at
+            self.task_log.time = f"{(self.task_log.ended_at - started_at).total_seconds():.2f}"
             self.task_log.status = status
 
             if isinstance(result, (dict, list)):
@@ -152,27 +336,123 @@ class BaseTask(object):
         return result
 
 
-def cancel(job_id):
-    jobs = rq.get_scheduler().get_jobs()
-    for job in jobs:
-        if job._id == job_id:
-            # print('job:', job.__dict__)
-            rq.get_scheduler().cancel(job)
+def cancel(*job_ids):
+    """
+    :param job_ids: ids of scheduled jobs
+    :return int: number of jobs removed from the schedule
+    """
+    return Scheduler.unschedule(rq.connection, job_ids)
+
+
+def cancel_by_description(description):
+    """
+    Cancel the scheduled jobs with this description, looked up in the index kept by Scheduler.
+    :return int: number of jobs removed from the schedule
+    """
+    key = Scheduler.description_key(description)
+    job_ids = [job_id.decode() for job_id in rq.connection.smembers(key)]
+    count = cancel(*job_ids)
+    #: ids of jobs deleted without being cancelled
+    rq.connection.delete(key)
+
+    return count
+
+
+def cancel_by_prefix(prefix):
+    """
+    Cancel the scheduled jobs whose id starts with `prefix`, a range of the id index kept by Scheduler.
+    :return int: number of jobs removed from the schedule
+    """
+    start = b"[" + prefix.encode()
+    job_ids = [job_id.decode() for job_id in rq.connection.zrangebylex(Scheduler.ids_key, start, start + b"\xff")]
+    return cancel(*job_ids)
+
+
+@lru_cache(maxsize=256)
+def _croniter(cron_string):
+    """ parsed cron expressions, re-positioned with set_current before use """
+    return croniter.croniter(cron_string, datetime.now(tzlocal()))
+
+
+_croniter_lock = threading.Lock()
 
 
 class Scheduler(rScheduler):
     job_class = FlaskJob
 
+    #: ids of the scheduled jobs, all scored 0 so that ZRANGEBYLEX serves cancel_by_prefix
+    ids_key = "rq:scheduler:ids"
+
     def __init__(self, *args, **kwargs):
         super(Scheduler, self).__init__(*args, **kwargs)
 
+    @staticmethod
+    def description_key(description):
+        """ set of the ids of the scheduled jobs with this description, see cancel_by_description """
+        return f"rq:scheduler:description:{description}"
+
+    @classmethod
+    def _index(cls, pipeline, job):
+        pipeline.zadd(cls.ids_key, 0, job.id)
+        if job.description:
+            pipeline.sadd(cls.description_key(job.description), job.id)
+
+    @classmethod
+    def _unindex(cls, pipeline, job_id, description):
+        """ every path a job leaves the schedule through ends here """
+        pipeline.zrem(cls.ids_key, job_id)
+        if description:
+            pipeline.srem(cls.description_key(description), job_id)
+
+    def reindex(self, jobs):
+        """
+        Index jobs scheduled before the indexes existed, see sync_schedules.
+        """
+        with self.connection._pipeline() as pipeline:
+            for job in jobs:
+                self._index(pipeline, job)
+            pipeline.execute()
+
+    @classmethod
+    def unschedule(cls, connection, job_ids):
+        """
+        Remove jobs from the schedule and from the indexes, the jobs themselves are kept.
+        :return int: number of jobs removed from the schedule
+        """
+        if not job_ids:
+            return 0
+
+        with connection.pipeline(transaction=False) as pipeline:
+            for job_id in job_ids:
+                pipeline.hget(Job.key_for(job_id), "description")
+            descriptions = pipeline.execute()
+
+        with connection.pipeline() as pipeline:
+            pipeline.zrem(cls.scheduled_jobs_key, *job_ids)
+            for job_id, description in zip(job_ids, descriptions):
+                cls._unindex(pipeline, job_id, description.decode() if description is not None else None)
+            return pipeline.execute()[0]
+
+    def cancel(self, job):
+        """
+        Pulls a job from the scheduler queue. This function accepts either a
+        job_id or a job instance.
+        """
+        self.unschedule(self.connection, [job.id if isinstance(job, self.job_class) else job])
+
     @classmethod
     def get_next_scheduled_time(cls, cron_string):
-        """Calculate the next scheduled time by creating a crontab object
-            with a cron string"""
+        """Calculate the next scheduled time from the cached crontab object
+            of a cron string"""
+
+        with _croniter_lock:
+            itr = _croniter(cron_string)
+            itr.set_current(datetime.now(tzlocal()))
+            return itr.get_next(datetime).astimezone(gettz("UTC"))
 
-        itr = croniter.croniter(cron_string, datetime.now(tzlocal()))
-        return itr.get_next(datetime).astimezone(gettz("UTC"))
+    def _zadd(self, pipeline, score, job_id):
+        """ StrictRedis signature, same as `connection._zadd` """
+        pipeline.zadd(self.scheduled_jobs_key, score, job_id)
 
     def schedule(self, scheduled_time, func, args=None, kwargs=None,
                  interval=None, repeat=None, result_ttl=None, ttl=None,
@@ -195,10 +475,12 @@ class Scheduler(rScheduler):
             job.meta['repeat'] = int(repeat)
         if repeat and interval is None:
             raise ValueError("Can't repeat a job without interval argument")
-        job.save()
-        self.connection._zadd(self.scheduled_jobs_key,
-                              to_unix(scheduled_time),
-                              job.id)
+
+        with self.connection._pipeline() as pipeline:
+            job.save(pipeline=pipeline)
+            self._zadd(pipeline, to_unix(scheduled_time), job.id)
+            self._index(pipeline, job)
+            pipeline.execute()
         return job
 
     def cron(self, cron_string, func, args=None, kwargs=None, repeat=None,
@@ -219,17 +501,33 @@ class Scheduler(rScheduler):
         if repeat is not None:
             job.meta['repeat'] = int(repeat)
 
-        job.save()
-
-        self.connection._zadd(self.scheduled_jobs_key,
-                              to_unix(scheduled_time),
-                              job.id)
+        with self.connection._pipeline() as pipeline:
+            job.save(pipeline=pipeline)
+            self._zadd(pipeline, to_unix(scheduled_time), job.id)
+            self._index(pipeline, job)
+            pipeline.execute()
         return job
 
-    def enqueue_job(self, job):
+    def enqueue_jobs(self):
+        """
+        Move every due job to its queue with one pipelined round trip.
+        """
+        self.log.debug('Checking for scheduled jobs')
+
+        jobs = self.get_jobs_to_queue()
+        with self.connection._pipeline() as pipeline:
+            for job in jobs:
+                self.enqueue_job(job, pipeline=pipeline)
+            # Refresh scheduler key's expiry, on every tick, due jobs or not
+            pipeline.expire(self.scheduler_key, int(self._interval) + 10)
+            pipeline.execute()
+        return jobs
+
+    def enqueue_job(self, job, pipeline=None):
         """
         Move a scheduled job to a queue. In addition, it also does puts the job
         back into the scheduler if needed.
+        :param pipeline: queue the commands on it instead of executing them
         """
         self.log.debug('Pushing {0} to {1}'.format(job.id, job.origin))
 
@@ -241,23 +539,21 @@ class Scheduler(rScheduler):
         if repeat:
             job.meta['repeat'] = int(repeat) - 1
 
+        pipe = pipeline if pipeline is not None else self.connection._pipeline()
+
         queue = self.get_queue_for_job(job)
-        queue.enqueue_job(job)
-        self.connection.zrem(self.scheduled_jobs_key, job.id)
-
-        if interval:
-            # If this is a repeat job and counter has reached 0, don't repeat
-            if repeat is not None:
-                if job.meta['repeat'] == 0:
-                    return
-            self.connection._zadd(self.scheduled_jobs_key,
-                                  to_unix(datetime.utcnow()) + int(interval),
-                                  job.id)
+        queue.enqueue_job(job, pipeline=pipe)
+        pipe.zrem(self.scheduled_jobs_key, job.id)
+
+        # If this is a repeat job and counter has reached 0, don't repeat
+        if repeat is not None and job.meta['repeat'] == 0:
+            self._unindex(pipe, job.id, job.description)
+        elif interval:
+            self._zadd(pipe, to_unix(datetime.utcnow()) + int(interval), job.id)
         elif cron_string:
-            # If this is a repeat job and counter has reached 0, don't repeat
-            if repeat is not None:
-                if job.meta['repeat'] == 0:
-                    return
-            self.connection._zadd(self.scheduled_jobs_key,
-                                  to_unix(self.get_next_scheduled_time(cron_string)),
-                                  job.id)
+            self._zadd(pipe, to_unix(self.get_next_scheduled_time(cron_string)), job.id)
+        else:
+            self._unindex(pipe, job.id, job.description)
+
+        if pipeline is None:
+            pipe.execute()
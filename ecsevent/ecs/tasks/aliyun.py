@@ -1,30 +1,130 @@
 # -*- coding:utf-8 -*-
 import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from queue import Queue, Full
 
-from aliyunsdkactiontrail.request.v20171204 import LookupEventsRequest
-from aliyunsdkcore import client
 from aniso8601 import parse_datetime
 from dateutil import tz
-from ecs.tasks import BaseTask, InvalidConfigError
+from sqlalchemy.exc import SQLAlchemyError
+from ecs.tasks import BaseTask, InvalidConfigError, rq
 from ali import Aliapi
-from ecs.event_model import AliEvent
+from ecs import event_cache, metrics
+from ecs.dedup import deduper
+from ecs.lease import LeaseLost
+from ecs.spool import TIME_FORMAT, parse_time as parse_spool_time
+from ecs.event_model import db, AliEvent, AliEventRollup, SyncCheckpoint, BackfillWindow
+
+log = logging.getLogger(__name__)
+
+
+def prefetch(iterable, depth=1):
+    """
+    Consume `iterable` on a background thread, at most `depth` items ahead,
+    so fetching the next page overlaps with handling the current one.
+    """
+    items = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as err:
+            put((False, err))
+            return
+        put((False, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
 
 class Aliyun(BaseTask):
 
-    def __init__(self, config, cron=False):
+    def __init__(self, config, cron=False, spool=None):
+        """
+        :param dict config: one shard, see shards
+        :param Spool spool: fetched pages go to this spool instead of straight to the database
+        """
         if not config:
             raise InvalidConfigError()
         self.ak = config["AK"]
         self.secret = config["SECRET"]
+        self.region_id = config.get("REGION", "cn-shenzhen")
+        #: ActionTrail endpoint override, e.g. a local stub
+        self.endpoint = config.get("ENDPOINT")
+        #: checkpoint key, defaults to the access key
+        self.account = config.get("ACCOUNT", self.ak)
+        #: seconds re-fetched before the checkpoint to pick up late events
+        self.overlap = config.get("OVERLAP", 120)
+        self.deduper = deduper
+        self.spool = spool
         self.api = self.get_api()
+        self._local = threading.local()
         self.cron = cron
         super(Aliyun, self).__init__(cron=self.cron)
 
+    @classmethod
+    def shards(cls, config):
+        """
+        Split the ALIYUN block into one config per account and region.
+        ACCOUNTS lists the accounts, each with AK, SECRET, ACCOUNT and REGION or REGIONS,
+        the other keys (OVERLAP...) are inherited from the block.
+        A block without ACCOUNTS is a single shard.
+        :return dict: {(account, region_id): config}
+        """
+        if not config:
+            raise InvalidConfigError()
+
+        shared = {key: value for key, value in config.items() if key != "ACCOUNTS"}
+        shards = {}
+        for account in config.get("ACCOUNTS") or [shared]:
+            account = dict(shared, **account)
+            regions = account.pop("REGIONS", None) or [account.get("REGION", "cn-shenzhen")]
+            for region_id in regions:
+                shard = dict(account, REGION=region_id)
+                shard.setdefault("ACCOUNT", shard["AK"])
+                shards[(shard["ACCOUNT"], region_id)] = shard
+
+        return shards
+
     @classmethod
     def parse_time(cls, _time):
         return parse_datetime(_time).astimezone(tz.tzlocal())
 
+    @classmethod
+    def utc_time(cls, _time):
+        """ aware request_time -> naive UTC, as stored in the checkpoint """
+        return _time.astimezone(tz.tzutc()).replace(tzinfo=None)
+
+    @classmethod
+    def local_time(cls, _time):
+        """ naive UTC -> naive local time, as stored in ali_event """
+        return _time.replace(tzinfo=tz.tzutc()).astimezone(tz.tzlocal()).replace(tzinfo=None)
+
     @classmethod
     def conv_event(cls, i):
         event = {
@@ -50,44 +150,260 @@ class Aliyun(BaseTask):
         return event
 
     def get_api(self):
-        return Aliapi(self.ak, self.secret)
+        return Aliapi(self.ak, self.secret, self.region_id, endpoint=self.endpoint, observe=self.observe_request)
 
-    def db_events_put(self, start_time=None, end_time=None):
-        events = [self.conv_event(event) for event in self.api.get_events(start_time, end_time)]
+    def observe_request(self, seconds, outcome):
+        metrics.api_request_seconds.observe(seconds, account=self.account, region_id=self.region_id, outcome=outcome)
+
+    @property
+    def thread_api(self):
+        """ AcsClient is not shared between backfill threads """
+        if not hasattr(self._local, "api"):
+            self._local.api = self.get_api()
+        return self._local.api
+
+    def fetch_window(self, start_time, end_time):
+        """
+        :return dict: converted events of the window keyed by event id
+        """
+        events = {}
+        pages = self.thread_api.iter_events(Aliapi.format_datetime(start_time), Aliapi.format_datetime(end_time))
+        for page in self.convert_pages(pages):
+            for event in page:
+                events[event["id"]] = event
 
-        for _event in events:
-            AliEvent.add(_event)
         return events
 
-    @staticmethod
-    def get_events():
-        clt = client.AcsClient('', '', 'cn-shenzhen')
-
-        request = LookupEventsRequest.LookupEventsRequest()
-        response = clt.do_action_with_exception(request)
-        return response
-
-    @staticmethod
-    def sync_events():
-        aliyun = []
-        event_ids = []
-        response = Aliyun.get_events()
-        result = json.loads(response)
-        # events += result["Events"]
-        results = result["Events"]
-        # print(results)
-        for event in results:
-            # print(event)
-            e = Aliyun.conv_event(event)
-            aliyun.append(e)
-        print(len(aliyun))
-        all_event_id = AliEvent.get_id()
-        for i in range(len(all_event_id)):
-            _id = str(all_event_id[i][0])
-            event_ids.append(_id)
-        print(len(event_ids))
-        for _event in aliyun:
-            if "user_agent" in _event.keys():
-                if len(_event["user_agent"]) > 255 or _event["id"] in event_ids:
-                    continue
-                res = AliEvent.add(_event)
+    def backfill_events(self, start_time, end_time, window=60, workers=4):
+        """
+        Fetch [start_time, end_time) in windows on a bounded thread pool, windows
+        finished by an earlier run are skipped.
+        :param datetime start_time: naive UTC
+        :param datetime end_time: naive UTC
+        :param int window: window size in minutes
+        :param int workers: concurrent fetches
+        :return dict: counts, and the error of every failed window in errors
+        """
+        windows = BackfillWindow.plan(self.account, self.region_id, start_time, end_time, timedelta(minutes=window))
+        todo = [w for w in windows if w.status != BackfillWindow.finished]
+        pending = iter(todo)
+        result = dict(windows=len(windows), skipped=len(windows) - len(todo), finished=0, failed=0, events=0,
+                      errors=[])
+
+        #: only writes on this thread, at most 2 * workers windows held in memory
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {}
+
+            def submit():
+                for w in pending:
+                    running[executor.submit(self.fetch_window, w.start_time, w.end_time)] = w
+                    if len(running) >= workers * 2:
+                        break
+
+            submit()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    w = running.pop(future)
+                    try:
+                        events = future.result()
+                        self.ingest(list(events.values()))
+                    except Exception as err:
+                        log.warning("backfill %s:%s %s - %s failed: %r", self.account, self.region_id,
+                                    w.start_time, w.end_time, err)
+                        w.mark(BackfillWindow.failed)
+                        result["failed"] += 1
+                        result["errors"].append(dict(start_time=w.start_time.isoformat(),
+                                                     end_time=w.end_time.isoformat(), error=repr(err)))
+                        continue
+
+                    w.mark(BackfillWindow.finished, len(events))
+                    result["finished"] += 1
+                    result["events"] += len(events)
+                submit()
+
+        return result
+
+    def iter_pages(self, start_time=None, end_time=None):
+        """
+        Converted events, one page at a time, the next page is fetched while
+        the caller handles the current one.
+        """
+        yield from self.convert_pages(prefetch(self.api.iter_events(start_time, end_time)))
+
+    def convert_pages(self, pages):
+        """
+        Converted events of raw `pages`, time spent waiting for a page is timed as fetch.
+        """
+        pages = iter(pages)
+        while True:
+            with self.phase("fetch"):
+                page = next(pages, None)
+            if page is None:
+                return
+
+            with self.phase("convert"), metrics.convert_seconds.time():
+                events = [self.conv_event(event) for event in page]
+            yield events
+
+    def db_events_put(self, start_time=None, end_time=None):
+        """
+        :return int: number of new events written
+        """
+        total = 0
+        for events in self.iter_pages(start_time, end_time):
+            total += len(self.ingest(events))
+
+        return total
+
+    def ingest(self, events):
+        """
+        Store the events the deduper has not seen yet and count them in the minute rollups.
+        Every writer (sync, spool drain, backfill, db_events_put) goes through here.
+        :return list: the new events
+        """
+        #: ali_user_agent holds 255 characters, a longer value would be truncated under the key of the full one,
+        #: events without a user agent are kept with a NULL key
+        received = len(events)
+        events = [_event for _event in events if len(_event.get("user_agent") or "") <= 255]
+        metrics.dedup_skipped.inc(received - len(events), reason="user_agent")
+        with self.phase("dedup"):
+            new = self.deduper.filter_new(events)
+        metrics.dedup_skipped.inc(len(events) - len(new), reason="deduper")
+
+        def bump(chunk):
+            with metrics.db_write_seconds.time(table=AliEventRollup.__tablename__):
+                AliEventRollup.bump(AliEventRollup.counts(chunk), commit=False)
+
+        with self.phase("write"):
+            #: events and their counts commit together, a replay deduped after a crash never misses a count
+            with metrics.db_write_seconds.time(table=AliEvent.__tablename__):
+                AliEvent.bulk_upsert(new, before_commit=bump)
+        self.deduper.add(_event["id"] for _event in new)
+        if new:
+            event_cache.bump_generation()
+
+        return new
+
+    def drain_spool(self):
+        """
+        Store what is spooled on this host and advance the checkpoints to the marks
+        drained with it, a database error leaves the rest for the next drain.
+        :return int: new events stored, None when another drain is running
+        """
+        new = [0]
+
+        def ingest(events):
+            new[0] += len(self.ingest(events))
+
+        def advance(marks):
+            for mark in marks:
+                SyncCheckpoint.load(mark["account"], mark["region_id"]).advance(
+                    (mark["request_time"], _id) for _id in mark["event_ids"]
+                )
+
+        if self.spool.drain(ingest, on_marks=advance) is None:
+            return None
+        return new[0]
+
+    @property
+    def spool_mark_key(self):
+        return f"ecs:spool:mark:{self.account}:{self.region_id}"
+
+    def load_spooled_checkpoint(self):
+        """
+        Where a spooling sync resumes, kept in Redis so the sync never waits on the database.
+        The database checkpoint, advanced by the drain, only seeds the first run.
+        :return SyncCheckpoint: transient, never added to the session
+        """
+        mark = rq.connection.get(self.spool_mark_key)
+        if mark is not None:
+            mark = json.loads(mark)
+            return SyncCheckpoint(account=self.account, region_id=self.region_id,
+                                  request_time=parse_spool_time(mark["request_time"]), event_ids=mark["event_ids"])
+
+        request_time, event_ids = None, []
+        try:
+            stored = SyncCheckpoint.load(self.account, self.region_id)
+            request_time, event_ids = stored.request_time, list(stored.event_ids or [])
+        except SQLAlchemyError:
+            #: no mark and no database, start from the default window
+            db.session.rollback()
+        return SyncCheckpoint(account=self.account, region_id=self.region_id,
+                              request_time=request_time, event_ids=event_ids)
+
+    def save_spooled_checkpoint(self, checkpoint):
+        if checkpoint.request_time is None:
+            return
+        rq.connection.set(self.spool_mark_key, json.dumps(dict(
+            request_time=checkpoint.request_time.strftime(TIME_FORMAT), event_ids=checkpoint.event_ids
+        )))
+
+    def sync_events(self, lost=None):
+        """
+        Fetch events from the checkpoint of this account/region forward
+        and advance it once they are stored.
+        With a spool the pages and the reached checkpoint are appended to it and the
+        resume point is kept in Redis, the run does not touch the database,
+        drain_spool stores the events and advances the database checkpoint.
+        :param threading.Event lost: set when the lease of the shard is taken over, checked before
+            every page and before the checkpoint moves, the new holder resumes from the old checkpoint
+        :return int: new events stored, or spooled, only stored events count in sync_run_events
+        :raise LeaseLost: `lost` was set
+        """
+        if self.spool is None:
+            checkpoint = SyncCheckpoint.load(self.account, self.region_id)
+        else:
+            checkpoint = self.load_spooled_checkpoint()
+        end_time = datetime.utcnow()
+        if checkpoint.request_time:
+            start_time = checkpoint.request_time - timedelta(seconds=self.overlap)
+        else:
+            start_time = end_time - timedelta(minutes=6)
+
+        if self.spool is None:
+            #: ids stored inside the window, older late events are checked against the db
+            self.deduper.warm(self.local_time(start_time))
+
+        #: only the newest timestamp and its ids are kept for the checkpoint
+        newest, newest_ids = None, []
+        count = pages = 0
+        for aliyun in self.iter_pages(Aliapi.format_datetime(start_time), Aliapi.format_datetime(end_time)):
+            if lost is not None and lost.is_set():
+                raise LeaseLost(f"sync {self.account}:{self.region_id} lease lost after {pages} pages")
+            pages += 1
+            fetched = len(aliyun)
+            aliyun = [
+                _event for _event in aliyun
+                if not checkpoint.seen(self.utc_time(_event["request_time"]), _event["id"])
+            ]
+            metrics.dedup_skipped.inc(fetched - len(aliyun), reason="checkpoint")
+            if self.spool is None:
+                count += len(self.ingest(aliyun))
+            else:
+                with self.phase("spool"):
+                    self.spool.append(aliyun)
+                count += len(aliyun)
+
+            for _event in aliyun:
+                _time = self.utc_time(_event["request_time"])
+                if newest is None or _time > newest:
+                    newest, newest_ids = _time, [_event["id"]]
+                elif _time == newest:
+                    newest_ids.append(_event["id"])
+
+        #: advance only after every page is stored or spooled, a crash mid-run re-fetches the window
+        if lost is not None and lost.is_set():
+            raise LeaseLost(f"sync {self.account}:{self.region_id} lease lost after {pages} pages")
+        if self.spool is None:
+            checkpoint.advance((newest, _id) for _id in newest_ids)
+        elif newest is not None:
+            checkpoint.move((newest, _id) for _id in newest_ids)
+            with self.phase("spool"):
+                self.spool.append_mark(self.account, self.region_id, checkpoint.request_time, checkpoint.event_ids)
+            self.save_spooled_checkpoint(checkpoint)
+        metrics.sync_run_pages.observe(pages, account=self.account, region_id=self.region_id)
+        if self.spool is None:
+            #: spooled events may still be dropped by the drain, it observes what it stores
+            metrics.sync_run_events.observe(count, account=self.account, region_id=self.region_id)
+        return count
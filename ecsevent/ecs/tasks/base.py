@@ -1,47 +1,84 @@
-def auto_add_modify_delete_items(tableObj, onlineDataList, keys=[], filters=[]):
+import hashlib
+import json
+
+from sqlalchemy import and_, or_
+
+from ecs.event_model import db, chunks
+
+
+def _keyname(row, keys):
+    if type(keys) == list and len(keys) > 0:
+        return '_'.join([str(row[k]) for k in keys])
+    return row.get('id')
+
+
+def _digest(row, columns):
+    values = json.dumps([row.get(c) for c in columns], sort_keys=True, default=str)
+    return hashlib.sha1(values.encode()).hexdigest()
+
+
+def auto_add_modify_delete_items(tableObj, onlineDataList, keys=[], filters=[], chunk_size=1000):
     '''
         根据线上数据，自动添加、修改、删除表里的数据。
         keys为组合key，filters为过滤条件
+        按组合key比较内容哈希，用集合运算算出增/改/删，再分批批量执行，整体一个事务。
+        :return dict: add/modify/delete/exist 数量
     '''
-    exist_items = tableObj.query.filter(*filters).all()
+    table = tableObj.__table__
+    pk = [c.name for c in table.primary_key.columns]
+    #: 只比较线上数据里出现的字段
+    columns = sorted({attr for _item in onlineDataList for attr in _item if attr in table.c})
+    load = [table.c[name] for name in dict.fromkeys(pk + (keys or ['id']) + columns) if name in table.c]
+
     storedDict = {}
-    for item in exist_items:
-        keyname = item.id
-        if type(keys) == list and len(keys) > 0:
-            keyname = '_'.join([str(getattr(item, k)) for k in keys])
-        storedDict[keyname] = item
-
-    # 添加数据库中不存在的， 修改变更的
-    add_list = []
-    exist_number = 0
-    full_keys = []
-    for _item in onlineDataList:
-        keyname = _item.get('id')
-        if type(keys) == list and len(keys) > 0:
-            keyname = '_'.join([str(_item[k]) for k in keys])
-        full_keys.append(keyname)
-        item = storedDict.get(keyname)
-        if item:
-            if item.to_dict().items() != _item.items():
-                for attr, value in _item.items():
-                    setattr(item, attr, value)
-                item.save()
-            exist_number += 1
-            continue
-        if _item not in add_list:
-            add_list.append(_item)
-    for _item in add_list:
-        tableObj(**_item).save()
-
-    # 删除数据库中多余的
-    delete_number = 0
-    for _id in set(storedDict.keys()).difference(set(full_keys)):
-        item = storedDict.get(_id)
-        if item:
-            item.delete()
-            delete_number += 1
-    add_number = len(add_list)
-    msg = f'{tableObj.__tablename__} add number :{add_number}, delete_number:{delete_number}, exist_number:{exist_number}, sql_rows:{len(exist_items)}'
-    print(msg)
-    return msg
+    sql_rows = 0
+    for row in db.session.query(*load).filter(*filters):
+        row = dict(zip([c.name for c in load], row))
+        storedDict[_keyname(row, keys)] = ({name: row[name] for name in pk}, _digest(row, columns))
+        sql_rows += 1
+
+    #: 同一个key以最后一条为准
+    onlineDict = {_keyname(_item, keys): _item for _item in onlineDataList}
+
+    add_keys = onlineDict.keys() - storedDict.keys()
+    delete_keys = storedDict.keys() - onlineDict.keys()
+    modify_keys = [
+        keyname for keyname in onlineDict.keys() & storedDict.keys()
+        if _digest(onlineDict[keyname], columns) != storedDict[keyname][1]
+    ]
+
+    try:
+        #: executemany 要求每行字段一致，按字段分组
+        groups = {}
+        for keyname in add_keys:
+            _item = onlineDict[keyname]
+            groups.setdefault(tuple(sorted(_item)), []).append(_item)
+        for rows in groups.values():
+            for chunk in chunks(rows, chunk_size):
+                db.session.execute(table.insert(), chunk)
+
+        mappings = (dict(onlineDict[keyname], **storedDict[keyname][0]) for keyname in modify_keys)
+        for chunk in chunks(mappings, chunk_size):
+            db.session.bulk_update_mappings(tableObj, chunk)
+
+        pk_values = (storedDict[keyname][0] for keyname in delete_keys)
+        for chunk in chunks(pk_values, chunk_size):
+            if len(pk) == 1:
+                where = table.c[pk[0]].in_([values[pk[0]] for values in chunk])
+            else:
+                where = or_(*[and_(*[table.c[name] == values[name] for name in pk]) for values in chunk])
+            db.session.execute(table.delete().where(where))
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
 
+    return {
+        "table": tableObj.__tablename__,
+        "add": len(add_keys),
+        "modify": len(modify_keys),
+        "delete": len(delete_keys),
+        "exist": len(onlineDict) - len(add_keys),
+        "sql_rows": sql_rows,
+    }
@@ -1,9 +1,21 @@
 # -*- coding:utf-8 -*-
 # Author:      Tim
-from ecs import current_app
-from ecs.tasks import InvalidFnError
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from ecs import current_app, db, metrics
+from ecs.event_model import AliEventRollup, SyncCheckpoint
+from ecs.lease import Semaphore, single_flight
+from ecs.partition import PartitionManager
+from ecs.spool import Spool
+from ecs.tasks import InvalidConfigError, InvalidFnError, rq, run
 from ecs.tasks.aliyun import Aliyun
 
+log = logging.getLogger(__name__)
+
 
 class Cron(object):
 
@@ -11,11 +23,172 @@ class Cron(object):
         self.aliyun_config = current_app.config['SRV'].get('ALIYUN')
 
     @property
-    def aliyun_task(self):
-        return Aliyun(self.aliyun_config, cron=True)
+    def aliyun_shards(self):
+        """
+        :return dict: {(account, region_id): config}, see Aliyun.shards
+        """
+        return Aliyun.shards(self.aliyun_config)
+
+    @property
+    def event_spool(self):
+        """
+        :return Spool: local spool of this host, None when EVENT_SPOOL_DIR is not set
+        """
+        config = current_app.config
+        if not config["EVENT_SPOOL_DIR"]:
+            return None
+        return Spool(config["EVENT_SPOOL_DIR"], config["EVENT_SPOOL_SEGMENT_BYTES"], config["EVENT_SPOOL_BATCH"])
+
+    def aliyun_task(self, account=None, region_id=None):
+        """
+        :return Aliyun: task of the shard, the first configured one by default
+        """
+        shards = self.aliyun_shards
+        if account is None and region_id is None:
+            return Aliyun(next(iter(shards.values())), cron=True, spool=self.event_spool)
+
+        config = shards.get((account, region_id))
+        if config is None:
+            raise InvalidConfigError()
+        return Aliyun(config, cron=True, spool=self.event_spool)
 
     def sync_aliyun_events(self):
-        self.aliyun_task.sync_events()
+        """
+        Fan out one job per account/region shard, a slow shard only delays itself.
+        :return list: job ids
+        """
+        return [
+            run.queue("cron", "sync_aliyun_shard", account, region_id,
+                      description=f"aliyun sync_events {account}:{region_id}").id
+            for account, region_id in self.aliyun_shards
+        ]
+
+    def sync_aliyun_shard(self, account, region_id):
+        """
+        One sync per shard at a time, see SYNC_LEASE_POLICY,
+        at most SYNC_MAX_SHARDS shards sync at once across all workers.
+        The outcome lands on the shard checkpoint once the lease is released, see SyncCheckpoint.report,
+        a database error only loses the report, not the run.
+        With EVENT_SPOOL_DIR the spool of this host is drained right after the run, on this worker,
+        every host that syncs drains its own spool.
+        :return dict: `events` fetched by the run, `stored` the new events the drain stored,
+            events other shards spooled on this host included
+        """
+        task = self.aliyun_task(account, region_id)
+        config = current_app.config
+        slots = Semaphore(rq.connection, "sync_aliyun_events", config["SYNC_MAX_SHARDS"], ttl=config["SYNC_LEASE_TTL"])
+        #: outcome of the last run, recorded after the lease is released
+        outcome = {}
+
+        def sync(lease):
+            started_at, started = datetime.utcnow(), time.monotonic()
+            if not slots.acquire(wait=config["SYNC_SLOT_WAIT"]):
+                outcome.update(status=SyncCheckpoint.deferred, started_at=started_at)
+                return None
+
+            try:
+                with slots.heartbeat():
+                    events = task.sync_events(lost=lease.lost)
+            except Exception as err:
+                db.session.rollback()
+                outcome.update(status=SyncCheckpoint.failed, started_at=started_at,
+                               duration=time.monotonic() - started, error=repr(err))
+                raise
+            finally:
+                slots.release()
+                task.save_timings()
+
+            outcome.update(status=SyncCheckpoint.finished, started_at=started_at,
+                           duration=time.monotonic() - started, events=events, error=None)
+            return events
+
+        try:
+            ran, events = single_flight(rq.connection, f"sync_aliyun_events:{account}:{region_id}", sync,
+                                        policy=config["SYNC_LEASE_POLICY"], ttl=config["SYNC_LEASE_TTL"])
+        finally:
+            if outcome:
+                try:
+                    SyncCheckpoint.load(account, region_id).record(**outcome)
+                except SQLAlchemyError as err:
+                    db.session.rollback()
+                    log.warning("sync %s:%s outcome not recorded: %r", account, region_id, err)
+
+        stored = events
+        if ran and task.spool is not None:
+            stored = self.drain_spool_after_sync(task)
+            if stored is not None:
+                metrics.sync_run_events.observe(stored, account=account, region_id=region_id)
+        return dict(account=account, region_id=region_id, ran=ran, events=events, stored=stored)
+
+    @staticmethod
+    def drain_spool_after_sync(task):
+        """
+        Outside of the lease and the slot, a slow or unavailable database does not hold the shard,
+        a database error leaves the spool to the next sync or drain_event_spool on this host.
+        :return int: new events stored, None when another drain was running or failed
+        """
+        try:
+            return task.drain_spool()
+        except SQLAlchemyError as err:
+            db.session.rollback()
+            log.warning("spool in %s not drained: %r", task.spool.directory, err)
+            return None
+        finally:
+            task.save_timings()
+
+    def drain_event_spool(self):
+        """
+        Store the events spooled on the host this job runs on and advance the checkpoints,
+        a catch-up for the drain after every sync, a database error leaves the rest for the next run.
+        """
+        task = self.aliyun_task()
+        if task.spool is None:
+            return None
+
+        try:
+            return dict(events=task.drain_spool(), backlog=task.spool.backlog())
+        finally:
+            task.save_timings()
+
+    def backfill_aliyun_events(self, start_time, end_time=None, window=60, workers=4, account=None, region_id=None):
+        """
+        :param str start_time: ISO 8601, e.g. 2021-01-01T00:00:00Z
+        :param str end_time: ISO 8601, defaults to now
+        :param int window: window size in minutes
+        :param int workers: concurrent fetches
+        :param str account: shard account, the first configured shard by default
+        :param str region_id: shard region
+        """
+        start_time = Aliyun.utc_time(Aliyun.parse_time(start_time))
+        end_time = Aliyun.utc_time(Aliyun.parse_time(end_time)) if end_time else datetime.utcnow()
+
+        task = self.aliyun_task(account, region_id)
+        try:
+            return task.backfill_events(start_time, end_time, window=window, workers=workers)
+        finally:
+            task.save_timings()
+
+    def maintain_event_partitions(self):
+        """
+        Create the coming ali_event partitions and drop the expired ones.
+        """
+        manager = PartitionManager(db.engine, retention_days=current_app.config["EVENT_RETENTION_DAYS"],
+                                   ahead=current_app.config["EVENT_PARTITIONS_AHEAD"])
+        return manager.maintain()
+
+    def compact_event_rollups(self):
+        """
+        Fold minute rollups older than the previous hour into hours,
+        hour rollups older than yesterday into days.
+        """
+        now = datetime.now()
+        hour = AliEventRollup.truncate[AliEventRollup.hour](now) - timedelta(hours=1)
+        day = AliEventRollup.truncate[AliEventRollup.day](now) - timedelta(days=1)
+
+        return dict(
+            minute=AliEventRollup.compact(AliEventRollup.minute, AliEventRollup.hour, hour),
+            hour=AliEventRollup.compact(AliEventRollup.hour, AliEventRollup.day, day),
+        )
 
     # @staticmethod
     # def test():
@@ -32,4 +205,4 @@ class Cron(object):
         if not (isinstance(fn, str) or not hasattr(self, fn)):
             raise InvalidFnError()
 
-        getattr(self, fn)(*args, **kwargs)
+        return getattr(self, fn)(*args, **kwargs)
@@ -0,0 +1,93 @@
+# -*- coding:utf-8 -*-
+"""
+Serialization of event lists the size of large /api/events pages and exports:
+    stdlib       json.dumps with AppJSONEncoder, the path every response used before
+    orjson       AppResponse.dumps with orjson installed, one bytes object for the whole list
+    stream_json  AppResponse.stream_json, orjson per chunk, the body never held in memory at once
+
+    python json_bench.py --sizes 10000 100000
+    python json_bench.py --sizes 100000 --chunk-size 1000
+
+Peak memory is measured with tracemalloc in a second pass, not in the timed one.
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from actiontrail_stub import synthetic_event
+
+
+def make_events(size):
+    from ecs.tasks.aliyun import Aliyun
+
+    start = datetime(2000, 1, 1)
+    return [
+        Aliyun.conv_event(synthetic_event(start + timedelta(seconds=index // 10), index))
+        for index in range(size)
+    ]
+
+
+def serializers(chunk_size):
+    """
+    :return dict: name -> function(events) -> bytes written
+    """
+    from ecs import AppJSONEncoder, AppResponse
+
+    def stream(events):
+        return sum(len(part) for part in AppResponse.stream_json(events, chunk_size).response)
+
+    return {
+        "stdlib": lambda events: len(json.dumps(events, separators=(',', ':'), sort_keys=True,
+                                                cls=AppJSONEncoder).encode()),
+        "orjson": lambda events: len(AppResponse.dumps(events)),
+        "stream_json": stream,
+    }
+
+
+def measure(serialize, events):
+    """
+    :return tuple: (seconds, bytes, peak MB)
+    """
+    started = time.perf_counter()
+    size = serialize(events)
+    seconds = time.perf_counter() - started
+
+    tracemalloc.start()
+    serialize(events)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return seconds, size, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--chunk-size", type=int, default=500)
+    args = parser.parse_args()
+
+    from ecs import App, orjson
+
+    if orjson is None:
+        print("orjson is not installed, AppResponse.dumps falls back to the stdlib encoder")
+
+    app = App("ecs")
+    app.config.from_object("ecs.config.AppConfig")
+
+    with app.app_context():
+        print(f"{'size':>8} {'serializer':<12} {'seconds':>8} {'MB':>8} {'MB/s':>8} {'peak MB':>8}")
+        for size in args.sizes:
+            events = make_events(size)
+            for name, serialize in serializers(args.chunk_size).items():
+                seconds, written, peak = measure(serialize, events)
+                print(f"{size:>8} {name:<12} {seconds:>8.3f} {written / 2 ** 20:>8.1f} "
+                      f"{written / 2 ** 20 / seconds:>8.1f} {peak:>8.1f}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""baseline: ali_event, sync checkpoint and backfill progress
+
+Revision ID: 0b1c7e3a5f21
+Revises: 
+Create Date: 2021-05-20 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+
+
+# revision identifiers, used by Alembic.
+revision = '0b1c7e3a5f21'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'ali_event',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=True),
+        sa.Column('source', sa.String(length=255), nullable=True),
+        sa.Column('request_time', sa.DateTime(), nullable=False),
+        sa.Column('type', sa.String(length=255), nullable=True),
+        sa.Column('version', sa.String(length=255), nullable=True),
+        sa.Column('err_code', sa.String(length=255), nullable=True),
+        sa.Column('err_msg', sa.Text(), nullable=True),
+        sa.Column('request_id', sa.String(length=64), nullable=True),
+        sa.Column('request_param', sqlalchemy_utils.types.json.JSONType(), nullable=True),
+        sa.Column('service_name', sa.String(length=64), nullable=True),
+        sa.Column('source_ip', sa.CHAR(length=64), nullable=True),
+        sa.Column('user_agent', sa.CHAR(length=255), nullable=True),
+        sa.Column('identity', sqlalchemy_utils.types.json.JSONType(), nullable=True),
+        sa.Column('created_by', sa.CHAR(length=128), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'ali_sync_checkpoint',
+        sa.Column('account', sa.String(length=64), nullable=False),
+        sa.Column('region_id', sa.String(length=64), nullable=False),
+        sa.Column('request_time', sa.DateTime(), nullable=True),
+        sa.Column('event_ids', sqlalchemy_utils.types.json.JSONType(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('account', 'region_id')
+    )
+    op.create_table(
+        'ali_backfill_window',
+        sa.Column('account', sa.String(length=64), nullable=False),
+        sa.Column('region_id', sa.String(length=64), nullable=False),
+        sa.Column('start_time', sa.DateTime(), nullable=False),
+        sa.Column('end_time', sa.DateTime(), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False),
+        sa.Column('events', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('account', 'region_id', 'start_time')
+    )
+
+
+def downgrade():
+    op.drop_table('ali_backfill_window')
+    op.drop_table('ali_sync_checkpoint')
+    op.drop_table('ali_event')
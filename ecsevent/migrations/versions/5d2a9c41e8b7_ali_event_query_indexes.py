@@ -0,0 +1,34 @@
+"""ali_event composite indexes for the keyset query API
+
+Revision ID: 5d2a9c41e8b7
+Revises: 0b1c7e3a5f21
+Create Date: 2021-05-24 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2a9c41e8b7'
+down_revision = '0b1c7e3a5f21'
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    'ix_ali_event_time': ['request_time', 'id'],
+    'ix_ali_event_service_time': ['service_name', 'request_time', 'id'],
+    'ix_ali_event_name_time': ['name', 'request_time', 'id'],
+    'ix_ali_event_user_time': ['created_by', 'request_time', 'id'],
+    'ix_ali_event_ip_time': ['source_ip', 'request_time', 'id'],
+    'ix_ali_event_err_time': ['err_code', 'request_time', 'id'],
+}
+
+
+def upgrade():
+    for name, columns in INDEXES.items():
+        op.create_index(name, 'ali_event', columns, unique=False)
+
+
+def downgrade():
+    for name in INDEXES:
+        op.drop_index(name, table_name='ali_event')
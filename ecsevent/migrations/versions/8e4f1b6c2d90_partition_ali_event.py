@@ -0,0 +1,56 @@
+"""partition ali_event by month on request_time
+
+Revision ID: 8e4f1b6c2d90
+Revises: 5d2a9c41e8b7
+Create Date: 2021-06-01 10:00:00.000000
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4f1b6c2d90'
+down_revision = '5d2a9c41e8b7'
+branch_labels = None
+depends_on = None
+
+
+def next_month(day):
+    return datetime.date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'mysql':
+        #: the partition column must be part of the primary key
+        with op.batch_alter_table('ali_event', recreate='always') as batch_op:
+            batch_op.create_primary_key('pk_ali_event', ['id', 'request_time'])
+        return
+
+    op.execute('ALTER TABLE ali_event DROP PRIMARY KEY, ADD PRIMARY KEY (id, request_time)')
+
+    #: one partition per month holding data, up to the current one, later months are added by the cron task
+    oldest = bind.execute(sa.text('SELECT MIN(request_time) FROM ali_event')).scalar() or datetime.datetime.now()
+    day, today = datetime.date(oldest.year, oldest.month, 1), datetime.date.today()
+    partitions = []
+    while day <= today:
+        upper = next_month(day)
+        partitions.append(f"PARTITION p{day:%Y%m} VALUES LESS THAN (TO_DAYS('{upper:%Y-%m-%d}'))")
+        day = upper
+    partitions.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+
+    op.execute(f"ALTER TABLE ali_event PARTITION BY RANGE (TO_DAYS(request_time)) ({', '.join(partitions)})")
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'mysql':
+        with op.batch_alter_table('ali_event', recreate='always') as batch_op:
+            batch_op.create_primary_key('pk_ali_event', ['id'])
+        return
+
+    op.execute('ALTER TABLE ali_event REMOVE PARTITIONING')
+    op.execute('ALTER TABLE ali_event DROP PRIMARY KEY, ADD PRIMARY KEY (id)')
@@ -0,0 +1,34 @@
+"""ali_event_rollup: event counts per minute/hour/day bucket
+
+Revision ID: a3c95e07d412
+Revises: 8e4f1b6c2d90
+Create Date: 2021-06-08 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c95e07d412'
+down_revision = '8e4f1b6c2d90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'ali_event_rollup',
+        sa.Column('granularity', sa.String(length=8), nullable=False),
+        sa.Column('bucket', sa.DateTime(), nullable=False),
+        sa.Column('service_name', sa.String(length=64), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('created_by', sa.String(length=128), nullable=False),
+        sa.Column('failed', sa.Boolean(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('granularity', 'bucket', 'service_name', 'name', 'created_by', 'failed')
+    )
+
+
+def downgrade():
+    op.drop_table('ali_event_rollup')
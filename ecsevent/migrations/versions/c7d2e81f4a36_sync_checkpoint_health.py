@@ -0,0 +1,34 @@
+"""ali_sync_checkpoint: outcome of the last run of each shard
+
+Revision ID: c7d2e81f4a36
+Revises: a3c95e07d412
+Create Date: 2021-06-15 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2e81f4a36'
+down_revision = 'a3c95e07d412'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('ali_sync_checkpoint') as batch_op:
+        batch_op.add_column(sa.Column('last_run_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('last_duration', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('last_status', sa.String(length=16), nullable=True))
+        batch_op.add_column(sa.Column('last_events', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('last_error', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('ali_sync_checkpoint') as batch_op:
+        batch_op.drop_column('last_error')
+        batch_op.drop_column('last_events')
+        batch_op.drop_column('last_status')
+        batch_op.drop_column('last_duration')
+        batch_op.drop_column('last_run_at')
@@ -0,0 +1,159 @@
+"""ali_event: identity, user_agent and service_name in dictionary tables keyed by a content hash
+
+Revision ID: e5b8a2c9d417
+Revises: c7d2e81f4a36
+Create Date: 2021-06-28 10:00:00.000000
+
+"""
+import hashlib
+import json
+
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8a2c9d417'
+down_revision = 'c7d2e81f4a36'
+branch_labels = None
+depends_on = None
+
+BATCH = 5000
+
+#: ali_event column -> (dictionary table, key column), same as AliEvent.encoded
+ENCODED = {
+    'service_name': ('ali_service', 'service_key'),
+    'user_agent': ('ali_user_agent', 'user_agent_key'),
+    'identity': ('ali_identity', 'identity_key'),
+}
+
+VIEW = """
+CREATE VIEW ali_event_view AS
+SELECT e.id, e.name, e.source, e.request_time, e.type, e.version, e.err_code, e.err_msg, e.request_id,
+       e.request_param, s.service_name, e.source_ip, u.user_agent, i.identity, e.created_by
+FROM ali_event e
+LEFT JOIN ali_service s ON s.id = e.service_key
+LEFT JOIN ali_user_agent u ON u.id = e.user_agent_key
+LEFT JOIN ali_identity i ON i.id = e.identity_key
+"""
+
+
+def key_of(value):
+    """ same as Dimension.key_of """
+    digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def canonical(name, value):
+    """
+    :return str: the value hashed and stored in the dictionary table, None for empty values
+    """
+    if value is None:
+        return None
+    if name == 'identity':
+        return json.dumps(json.loads(value), sort_keys=True, separators=(',', ':'))
+    #: CHAR values may come back padded
+    return value.rstrip() if name == 'user_agent' else value
+
+
+def backfill(bind):
+    """
+    Fill the key columns and the dictionary tables, keyset paginated on (request_time, id).
+    """
+    ignore = 'IGNORE' if bind.dialect.name == 'mysql' else 'OR IGNORE'
+    seen = {name: set() for name in ENCODED}
+    after = None
+    while True:
+        query = 'SELECT id, request_time, service_name, user_agent, identity FROM ali_event'
+        if after is not None:
+            query += ' WHERE request_time > :time OR (request_time = :time AND id > :id)'
+        query += f' ORDER BY request_time, id LIMIT {BATCH}'
+        rows = bind.execute(sa.text(query), dict(time=after[0], id=after[1]) if after else {}).fetchall()
+        if not rows:
+            return
+
+        updates = []
+        for row in rows:
+            update = {'_id': row.id, '_time': row.request_time}
+            for name, (table, key_column) in ENCODED.items():
+                value = canonical(name, row[name])
+                key = None if value is None else key_of(value)
+                update[key_column] = key
+                if key is not None and key not in seen[name]:
+                    seen[name].add(key)
+                    bind.execute(sa.text(f'INSERT {ignore} INTO {table} (id, {name}) VALUES (:id, :value)'),
+                                 dict(id=key, value=value))
+            updates.append(update)
+
+        bind.execute(sa.text(
+            'UPDATE ali_event SET service_key = :service_key, user_agent_key = :user_agent_key, '
+            'identity_key = :identity_key WHERE id = :_id AND request_time = :_time'
+        ), updates)
+        after = rows[-1].request_time, rows[-1].id
+
+
+def upgrade():
+    op.create_table(
+        'ali_service',
+        sa.Column('id', sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column('service_name', sa.String(length=64), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'ali_user_agent',
+        sa.Column('id', sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column('user_agent', sa.String(length=255), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'ali_identity',
+        sa.Column('id', sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column('identity', sqlalchemy_utils.types.json.JSONType(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    with op.batch_alter_table('ali_event') as batch_op:
+        batch_op.add_column(sa.Column('service_key', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('user_agent_key', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('identity_key', sa.BigInteger(), nullable=True))
+
+    backfill(op.get_bind())
+
+    with op.batch_alter_table('ali_event') as batch_op:
+        batch_op.drop_index('ix_ali_event_service_time')
+        batch_op.drop_column('identity')
+        batch_op.drop_column('user_agent')
+        batch_op.drop_column('service_name')
+        batch_op.alter_column('source_ip', existing_type=sa.CHAR(length=64), type_=sa.String(length=64))
+        batch_op.alter_column('created_by', existing_type=sa.CHAR(length=128), type_=sa.String(length=128),
+                              existing_nullable=False)
+        batch_op.create_index('ix_ali_event_service_time', ['service_key', 'request_time', 'id'], unique=False)
+
+    op.execute(VIEW)
+
+
+def downgrade():
+    op.execute('DROP VIEW IF EXISTS ali_event_view')
+
+    with op.batch_alter_table('ali_event') as batch_op:
+        batch_op.add_column(sa.Column('service_name', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('user_agent', sa.CHAR(length=255), nullable=True))
+        batch_op.add_column(sa.Column('identity', sqlalchemy_utils.types.json.JSONType(), nullable=True))
+
+    for name, (table, key_column) in ENCODED.items():
+        op.execute(f'UPDATE ali_event SET {name} = (SELECT {name} FROM {table} WHERE {table}.id = ali_event.{key_column})')
+
+    with op.batch_alter_table('ali_event') as batch_op:
+        batch_op.drop_index('ix_ali_event_service_time')
+        batch_op.drop_column('identity_key')
+        batch_op.drop_column('user_agent_key')
+        batch_op.drop_column('service_key')
+        batch_op.alter_column('source_ip', existing_type=sa.String(length=64), type_=sa.CHAR(length=64))
+        batch_op.alter_column('created_by', existing_type=sa.String(length=128), type_=sa.CHAR(length=128),
+                              existing_nullable=False)
+        batch_op.create_index('ix_ali_event_service_time', ['service_name', 'request_time', 'id'], unique=False)
+
+    op.drop_table('ali_identity')
+    op.drop_table('ali_user_agent')
+    op.drop_table('ali_service')
@@ -0,0 +1,84 @@
+# -*- coding:utf-8 -*-
+"""
+Scheduler ticks/sec with N due cron jobs per tick:
+    rq_scheduler  rq_scheduler.Scheduler, a few round trips per due job, the scheduler used before
+    ecs           ecs.tasks.Scheduler, every due job moved in one pipeline, cached crontabs
+
+    python scheduler_bench.py --jobs 10 100 1000
+    python scheduler_bench.py --redis-url redis://127.0.0.1:6379/15
+
+Defaults to fakeredis (not a requirement, install it to run without a server), which hides the
+network round trips: run it against a real Redis to see them. The database is flushed, use a spare one.
+"""
+import argparse
+import sys
+import time
+
+from redis import StrictRedis
+
+
+def connect(redis_url):
+    if redis_url:
+        return StrictRedis.from_url(redis_url)
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit("fakeredis is not installed, pass --redis-url")
+    return fakeredis.FakeStrictRedis()
+
+
+def ticks_per_second(scheduler, connection, jobs, ticks):
+    """
+    :return float: enqueue_jobs calls per second, every job due on every call
+    """
+    connection.flushdb()
+    ids = [scheduler.cron("* * * * *", "os.getcwd", id=f"bench-{index}", description="bench").id
+           for index in range(jobs)]
+
+    seconds = 0
+    for _ in range(ticks):
+        #: every job due again and an empty queue, outside of the timed part
+        with connection.pipeline() as pipeline:
+            for job_id in ids:
+                pipeline.zadd(scheduler.scheduled_jobs_key, 0, job_id)
+            pipeline.delete("rq:queue:default")
+            pipeline.execute()
+
+        started = time.perf_counter()
+        enqueued = scheduler.enqueue_jobs()
+        seconds += time.perf_counter() - started
+        assert len(enqueued) == jobs
+
+    connection.flushdb()
+    return ticks / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[10, 100, 1000], help="due jobs per tick")
+    parser.add_argument("--ticks", type=int, default=20)
+    parser.add_argument("--redis-url", default=None, help="defaults to fakeredis")
+    args = parser.parse_args()
+
+    from rq_scheduler import Scheduler as rScheduler
+    from ecs.tasks import Scheduler
+
+    connection = connect(args.redis_url)
+    schedulers = {
+        "rq_scheduler": rScheduler(connection=connection),
+        "ecs": Scheduler(connection=connection),
+    }
+
+    print(f"{'jobs':>6} {'scheduler':<12} {'ticks/s':>10} {'jobs/s':>10}")
+    for jobs in args.jobs:
+        result = {}
+        for name, scheduler in schedulers.items():
+            result[name] = ticks_per_second(scheduler, connection, jobs, args.ticks)
+            print(f"{jobs:>6} {name:<12} {result[name]:>10.1f} {result[name] * jobs:>10.0f}")
+        print(f"{'':>6} {'speedup':<12} {result['ecs'] / result['rq_scheduler']:>9.1f}x")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+"""
+Cold start benchmark of the CLI / worker entry point, with `python -X importtime`.
+
+    python startup_bench.py --runs 5
+    python startup_bench.py --save
+
+Every stage runs in a fresh interpreter:
+    import  `import Ecs_app`, must not load the Aliyun SDK, the task modules or rq
+    app     `import Ecs_app` and build the app, still without the SDK
+
+Results are compared with the saved baseline, the exit status is 1 when a stage got slower
+by more than --tolerance or loaded one of the modules it must not.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = {
+    "import": "import Ecs_app",
+    "app": "import Ecs_app; Ecs_app.load_app()",
+}
+#: stage -> modules it must not import
+LAZY = {
+    "import": ("aliyunsdkcore", "ali", "ecs.tasks", "ecs.tasks.aliyun", "rq", "flask_migrate", "sqlalchemy_utils",
+               "sqlalchemy.dialects.mysql"),
+    "app": ("aliyunsdkcore", "ali", "ecs.tasks.aliyun", "ecs.tasks.cron"),
+}
+
+
+def importtime(code):
+    """
+    :return tuple: (total ms, {module: self ms}) of one fresh interpreter running `code`
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=BASE_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr)
+
+    modules, total = {}, 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(self_us) / 1000
+        #: top level imports only, nested ones are part of their cumulative time
+        if not name.startswith("  "):
+            total += int(cumulative_us) / 1000
+
+    return total, modules
+
+
+def run_stage(stage, runs):
+    totals, modules = [], {}
+    for _ in range(runs):
+        total, modules = importtime(STAGES[stage])
+        totals.append(total)
+
+    slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:10]
+    return {
+        "median_ms": round(statistics.median(totals), 1),
+        "min_ms": round(min(totals), 1),
+        "modules": len(modules),
+        "eager": [name for name in LAZY[stage] if name in modules],
+        "slowest": [[name, round(ms, 1)] for name, ms in slowest],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--baseline", default=os.path.join(BASE_DIR, "startup_bench.json"))
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    failed = False
+    for stage in STAGES:
+        result = run_stage(stage, args.runs)
+        print(f"{stage:<8} median {result['median_ms']:>8} ms  min {result['min_ms']:>8} ms  "
+              f"{result['modules']} modules")
+        for name, ms in result["slowest"][:5]:
+            print(f"    {ms:>8} ms  {name}")
+
+        if result["eager"]:
+            failed = True
+            print(f"    imported eagerly: {', '.join(result['eager'])}")
+        baseline = baselines.get(stage)
+        if baseline and not args.save and result["median_ms"] > baseline["median_ms"] * (1 + args.tolerance):
+            failed = True
+            print(f"    regression against baseline: {result['median_ms']} ms > {baseline['median_ms']} ms")
+        if args.save:
+            baselines[stage] = result
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.baseline}")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import threading
+
+import pytest
+
+from actiontrail_stub import StubServer
+
+aio_ali = pytest.importorskip("aio_ali")
+
+START, END = "2000-01-01T00:00:00Z", "2000-01-01T00:10:00Z"
+
+
+@pytest.fixture
+def stub():
+    server = StubServer(("127.0.0.1", 0), events_per_minute=30)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(client, slices=1):
+    async def run():
+        async with client:
+            return await client.get_events(START, END, slices=slices)
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(run())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def client(stub, **kwargs):
+    return aio_ali.AsyncAliapi("ak", "secret", endpoint=f"http://{stub.endpoint}", **kwargs)
+
+
+def test_throttled_requests_are_retried(stub):
+    stub.throttle = 0.5
+    api = client(stub, base_delay=0.001, max_delay=0.01, max_retries=20)
+
+    events = fetch(api, slices=2)
+
+    assert len({event["eventId"] for event in events}) == len(events) == 301
+    assert api.stats["throttled"] > 0
+    assert api.stats["retries"] == api.stats["throttled"]
+
+
+def test_throttling_past_max_retries_fails(stub):
+    stub.throttle = 1.0
+    api = client(stub, base_delay=0.001, max_retries=2)
+
+    with pytest.raises(ValueError, match="Throttling.User"):
+        fetch(api)
+    assert (api.stats["requests"], api.stats["failed"]) == (3, 1)
+
+
+def test_client_runs_on_successive_loops(stub):
+    api = client(stub, concurrency=2)
+
+    assert len(fetch(api, slices=4)) == len(fetch(api, slices=4)) == 301
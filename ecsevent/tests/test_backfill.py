@@ -0,0 +1,45 @@
+# -*- coding:utf-8 -*-
+from datetime import datetime, timedelta
+
+from ecs.event_model import BackfillWindow
+
+START = datetime(2021, 1, 1)
+HOUR = timedelta(hours=1)
+
+
+def plan(end_time):
+    return BackfillWindow.plan("prod", "cn-shenzhen", START, end_time, HOUR)
+
+
+def test_plan_covers_the_range(app):
+    windows = plan(START + 2.5 * HOUR)
+
+    assert [(w.start_time, w.end_time) for w in windows] == [
+        (START, START + HOUR), (START + HOUR, START + 2 * HOUR), (START + 2 * HOUR, START + 2.5 * HOUR)
+    ]
+    assert {w.status for w in windows} == {BackfillWindow.pending}
+
+
+def test_rerun_keeps_finished_windows(app):
+    for window in plan(START + 2 * HOUR):
+        window.mark(BackfillWindow.finished, 10)
+
+    windows = plan(START + 2 * HOUR)
+
+    assert [w.status for w in windows] == [BackfillWindow.finished] * 2
+    assert [w.events for w in windows] == [10, 10]
+
+
+def test_rerun_with_a_later_end_refetches_the_partial_window(app):
+    for window in plan(START + 1.5 * HOUR):
+        window.mark(BackfillWindow.finished, 10)
+
+    windows = plan(START + 3 * HOUR)
+
+    assert [(w.start_time, w.end_time, w.status) for w in windows] == [
+        (START, START + HOUR, BackfillWindow.finished),
+        (START + HOUR, START + 2 * HOUR, BackfillWindow.pending),
+        (START + 2 * HOUR, START + 3 * HOUR, BackfillWindow.pending),
+    ]
+    stored = BackfillWindow.query.filter_by(start_time=START + HOUR).one()
+    assert (stored.end_time, stored.status, stored.events) == (START + 2 * HOUR, BackfillWindow.pending, 0)
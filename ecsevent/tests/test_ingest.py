@@ -0,0 +1,48 @@
+# -*- coding:utf-8 -*-
+from datetime import datetime, timedelta
+
+import pytest
+
+from actiontrail_stub import synthetic_event
+from ecs import metrics
+from ecs.event_model import AliEvent
+from ecs.tasks.aliyun import Aliyun
+
+
+@pytest.fixture
+def task(app):
+    task = Aliyun({"AK": "ak", "SECRET": "secret", "ACCOUNT": "prod"})
+    task.deduper.ids.clear()
+    return task
+
+
+def events(count):
+    start = datetime(2021, 1, 1)
+    return [Aliyun.conv_event(synthetic_event(start + timedelta(seconds=index), index)) for index in range(count)]
+
+
+def test_ingest_keeps_events_without_a_user_agent(task, redis):
+    metrics.flush(redis)
+    redis.flushall()
+
+    missing, empty, too_long, kept = events(4)
+    del missing["user_agent"]
+    empty["user_agent"] = None
+    too_long["user_agent"] = "x" * 256
+
+    new = task.ingest([missing, empty, too_long, kept])
+
+    assert [_event["id"] for _event in new] == [missing["id"], empty["id"], kept["id"]]
+    assert {event.id: event.to_dict()["user_agent"] for event in AliEvent.query} == {
+        missing["id"]: None, empty["id"]: None, kept["id"]: kept["user_agent"],
+    }
+    metrics.flush(redis)
+    assert 'ecs_dedup_skipped_total{reason="user_agent"} 1' in metrics.render(redis).splitlines()
+
+
+def test_ingest_skips_stored_events(task):
+    batch = events(3)
+
+    assert len(task.ingest(batch)) == 3
+    assert task.ingest(batch) == []
+    assert AliEvent.query.count() == 3
@@ -0,0 +1,163 @@
+# -*- coding:utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from actiontrail_stub import StubServer
+from ecs import metrics, tasks
+from ecs.event_model import AliEvent, SyncCheckpoint
+from ecs.lease import Lease, LeaseLost, Semaphore, single_flight
+
+
+@pytest.fixture
+def stub():
+    server = StubServer(("127.0.0.1", 0), events_per_minute=60)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cron(app, redis, stub, monkeypatch):
+    from ecs.tasks.cron import Cron
+
+    monkeypatch.setattr(tasks.rq, "_ready_to_connect", True)
+    monkeypatch.setattr(tasks.rq, "_connection", redis)
+    app.config["SRV"] = {"ALIYUN": {"AK": "ak", "SECRET": "secret", "ACCOUNT": "prod", "ENDPOINT": stub.endpoint}}
+    cron = Cron()
+    #: the stub serves the same ids to every test
+    cron.aliyun_task().deduper.ids.clear()
+    return cron
+
+
+def test_lease_is_exclusive_until_released(redis):
+    first, second = Lease(redis, "sync"), Lease(redis, "sync")
+
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.release()
+    assert second.acquire()
+
+
+def test_expired_lease_is_taken_over(redis):
+    first, second = Lease(redis, "sync", ttl=0.1), Lease(redis, "sync", ttl=60)
+    assert first.acquire()
+    time.sleep(0.2)
+
+    assert second.acquire()
+    #: the old holder can neither keep nor drop the lease of the new one
+    assert not first.renew()
+    assert not first.release()
+    assert redis.get(second.key) == second.token
+
+
+def test_heartbeat_sets_lost_on_takeover(redis):
+    lease = Lease(redis, "sync", ttl=0.3)
+    assert lease.acquire()
+
+    with lease.heartbeat(interval=0.05):
+        redis.set(lease.key, b"other")
+        assert lease.lost.wait(1)
+
+
+def test_single_flight_skips_a_concurrent_run(redis):
+    holder = Lease(redis, "sync")
+    assert holder.acquire()
+
+    assert single_flight(redis, "sync", lambda lease: 1) == (False, None)
+    assert redis.get(holder.pending_key) is None
+
+
+def test_single_flight_coalesces_a_concurrent_run(redis):
+    runs = []
+
+    def func(lease):
+        runs.append(lease)
+        if len(runs) == 1:
+            #: a call made while this one runs
+            assert single_flight(redis, "sync", func, policy=Lease.coalesce) == (False, None)
+        return len(runs)
+
+    assert single_flight(redis, "sync", func, policy=Lease.coalesce) == (True, 2)
+    assert runs[0] is runs[1]
+    assert redis.get(runs[0].key) is None
+
+
+def test_semaphore_exhaustion_and_release(redis):
+    holders = [Semaphore(redis, "sync", 2) for _ in range(3)]
+
+    assert [holder.acquire() for holder in holders] == [True, True, False]
+    assert holders[0].holders() == 2
+    assert holders[0].release()
+    assert holders[2].acquire()
+    assert holders[0].holders() == 2
+
+
+def test_expired_semaphore_slot_is_reclaimed(redis):
+    stale, waiting = Semaphore(redis, "sync", 1, ttl=0.1), Semaphore(redis, "sync", 1, ttl=0.1)
+    assert stale.acquire()
+    time.sleep(0.2)
+
+    assert waiting.acquire()
+    assert not stale.renew()
+
+
+def test_sync_stops_before_the_checkpoint_moves(cron):
+    task = cron.aliyun_task()
+    lost = threading.Event()
+    iter_pages = task.iter_pages
+
+    def lose_after_first_page(*args, **kwargs):
+        for page in iter_pages(*args, **kwargs):
+            yield page
+            lost.set()
+
+    task.iter_pages = lose_after_first_page
+    with pytest.raises(LeaseLost):
+        task.sync_events(lost=lost)
+
+    assert SyncCheckpoint.load("prod", "cn-shenzhen").request_time is None
+
+
+def test_shard_sync_with_a_lost_lease_is_failed_and_frees_its_slot(cron, app, redis, monkeypatch):
+    from ecs.tasks.aliyun import Aliyun
+
+    app.config["SYNC_LEASE_TTL"] = 0.3
+    monkeypatch.setattr(Lease, "renew", lambda self: False)
+    sync_events = Aliyun.sync_events
+
+    def slow_sync(self, lost=None):
+        #: long enough for the first heartbeat to find the lease gone
+        time.sleep(0.3)
+        return sync_events(self, lost=lost)
+
+    monkeypatch.setattr(Aliyun, "sync_events", slow_sync)
+    with pytest.raises(LeaseLost):
+        cron.sync_aliyun_shard("prod", "cn-shenzhen")
+
+    checkpoint = SyncCheckpoint.load("prod", "cn-shenzhen")
+    assert (checkpoint.request_time, checkpoint.last_status) == (None, SyncCheckpoint.failed)
+    assert Semaphore(redis, "sync_aliyun_events", 1).holders() == 0
+
+
+def test_shard_sync_drains_its_spool_and_counts_stored_events(cron, app, redis, tmpdir):
+    app.config["EVENT_SPOOL_DIR"] = str(tmpdir.join("spool"))
+    metrics.flush(redis)
+    redis.flushall()
+
+    first = cron.sync_aliyun_shard("prod", "cn-shenzhen")
+    #: the overlap window is fetched and spooled again, the drain drops it
+    second = cron.sync_aliyun_shard("prod", "cn-shenzhen")
+
+    stored = AliEvent.query.count()
+    assert first["stored"] == first["events"] > 0
+    assert first["stored"] + second["stored"] == stored
+    assert second["stored"] < second["events"]
+    assert cron.aliyun_task().spool.backlog() == 0
+    assert SyncCheckpoint.load("prod", "cn-shenzhen").request_time is not None
+
+    metrics.flush(redis)
+    samples = metrics.render(redis).splitlines()
+    assert f'ecs_sync_run_events_sum{{account="prod",region_id="cn-shenzhen"}} {stored}' in samples
@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+import datetime
+
+import pytest
+
+from ecs.event_model import AliEvent, db
+from ecs.partition import PartitionManager
+
+
+@pytest.fixture
+def manager(app):
+    return PartitionManager(db.engine, retention_days=60, ahead=1)
+
+
+def store(*days):
+    AliEvent.bulk_upsert([
+        dict(id=f"e{index}", request_time=datetime.datetime.combine(day, datetime.time(12)), name="StopInstance",
+             service_name="Ecs", source_ip="10.0.0.1", created_by="ops")
+        for index, day in enumerate(days)
+    ])
+
+
+def partitions(manager):
+    with db.engine.begin() as connection:
+        return manager.backend(connection).list()
+
+
+def test_maintain_across_a_month_boundary(manager):
+    assert manager.maintain(datetime.date(2021, 1, 31)) == dict(created=["p202101", "p202102"], dropped=[])
+    assert manager.maintain(datetime.date(2021, 1, 31)) == dict(created=[], dropped=[])
+    assert manager.maintain(datetime.date(2021, 2, 1)) == dict(created=["p202103"], dropped=[])
+
+    assert partitions(manager) == {
+        "p202101": datetime.date(2021, 2, 1),
+        "p202102": datetime.date(2021, 3, 1),
+        "p202103": datetime.date(2021, 4, 1),
+    }
+
+
+def test_maintain_drops_the_months_past_retention(manager):
+    manager.maintain(datetime.date(2021, 1, 1))
+    store(datetime.date(2021, 1, 15), datetime.date(2021, 1, 31), datetime.date(2021, 2, 1))
+
+    #: no run in March, p202104 starts at the bound of p202102; 2021-04-02 minus 60 days
+    #: is 2021-02-01, the upper bound of January
+    assert manager.maintain(datetime.date(2021, 4, 1)) == dict(created=["p202104", "p202105"], dropped=[])
+    assert manager.maintain(datetime.date(2021, 4, 2)) == dict(created=[], dropped=["p202101"])
+
+    assert sorted(partitions(manager)) == ["p202102", "p202104", "p202105"]
+    assert [event.id for event in AliEvent.query] == ["e2"]
@@ -0,0 +1,15 @@
+# -*- coding:utf-8 -*-
+from startup_bench import LAZY, importtime
+
+#: module name prefixes `import Ecs_app` must not load, the CLI and the worker pay for them on first use
+LAZY_PREFIXES = ("rq", "rq_scheduler", "flask_rq2", "aliyunsdk", "sqlalchemy.dialects.", "sqlalchemy_utils",
+                 "ecs.tasks", "flask_migrate", "alembic")
+
+
+def test_import_loads_no_lazy_module():
+    _, modules = importtime("import Ecs_app")
+
+    assert "Ecs_app" in modules
+    eager = sorted(name for name in modules if name.startswith(LAZY_PREFIXES))
+    assert eager == []
+    assert [name for name in LAZY["import"] if name in modules] == []
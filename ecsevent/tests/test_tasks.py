@@ -0,0 +1,27 @@
+# -*- coding:utf-8 -*-
+import pytest
+from rq.job import Job
+
+from ecs import tasks
+
+
+@pytest.fixture
+def connection(redis, monkeypatch):
+    monkeypatch.setattr(tasks.rq, "_ready_to_connect", True)
+    monkeypatch.setattr(tasks.rq, "_connection", redis)
+    return redis
+
+
+@pytest.mark.parametrize("description, expected", [
+    ("ecs.tasks.run('cron', 'sync_aliyun_events')", "run('cron', 'sync_aliyun_events')"),
+    ("aliyun sync_events prod:cn-shenzhen", "aliyun sync_events prod:cn-shenzhen"),
+    ("event rollups", "event rollups"),
+    ("adhoc", "adhoc"),
+])
+def test_get_results_many_strips_the_module_prefix_only(connection, description, expected):
+    connection.hmset(Job.key_for("job"), {"status": "queued", "description": description})
+
+    assert tasks.get_results_many(["job", "missing"]) == {
+        "job": dict(result=None, status="queued", time=None, description=expected),
+        "missing": None,
+    }
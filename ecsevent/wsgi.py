@@ -0,0 +1,9 @@
+# -*- coding:utf-8 -*-
+"""
+WSGI entry point, the app is built on import:
+
+    gunicorn -w 4 -b 0.0.0.0:8000 wsgi:app
+"""
+from Ecs_app import load_app
+
+app = load_app()